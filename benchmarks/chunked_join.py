@@ -0,0 +1,119 @@
+"""Chunked encode check
+
+Encodes each source to each FLAC format whole, and as with
+--chunk-duration, then decodes both and checks that they have the same
+number of samples and the same audio MD5, and that the STREAMINFO of the
+output reports them. Sources are only encoded in segments where OATS would
+do so, which is not when the format resamples them or changes their bit
+depth. Also reports the time taken by each way of encoding. Exits with
+status 1 if any output does not match.
+
+Usage:
+  chunked_join.py [options] <source> ...
+
+Options:
+  -c --chunk-duration=<seconds>  The length of the segments [default: 30].
+  -f --formats=<fmt-list>        The FLAC formats to encode to [default: FLAC,FLAC 16 44100].
+  -p --processes=<n>             The number of tasks run at once [default: 4].
+  -E --profile=<profile>         The encoder effort profile [default: archival].
+  -h --help                      Show this screen.
+"""
+
+import asyncio
+import hashlib
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from oats import flacjoin
+from oats.engine import Engine
+from oats.script import FFMPEG, PROBE, Format, TranscodeTemplate, chunkable, chunked_tasks
+from oats.script import format_codec_map, transcode_task
+
+
+def run(tasks, processes):
+    """Run tasks by the engine, returning the time taken and whether all succeeded"""
+    async def run_all():
+        succeeded = True
+        async for task in Engine(processes).run(tasks):
+            succeeded = succeeded and not task.failed
+        return succeeded
+    start = time.perf_counter()
+    succeeded = asyncio.run(run_all())
+    return time.perf_counter() - start, succeeded
+
+
+def streaminfo(path):
+    """Return the channels, bits per sample, total samples and MD5 of a FLAC file"""
+    with open(path, 'rb') as f:
+        blocks, _first_frame = flacjoin.read_metadata(f.read(2**20))
+    info = blocks[0][1]
+    packed = int.from_bytes(info[10:18], 'big')
+    return ((packed >> 41) & 0x07) + 1, ((packed >> 36) & 0x1F) + 1, packed & 0xFFFFFFFFF, info[18:34].hex()
+
+
+def decoded(path):
+    """Decode a FLAC file, returning its number of samples and the MD5 of its audio"""
+    channels, bits, _samples, _md5 = streaminfo(path)
+    fmt = {8: 's8', 16: 's16le', 24: 's24le', 32: 's32le'}[bits]
+    command = ['ffmpeg', '-v', 'error', '-i', path, '-map', '0:a', '-f', fmt, '-']
+    md5, size = hashlib.md5(), 0
+    with subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE) as proc:
+        for chunk in iter(lambda: proc.stdout.read(2**20), b''):
+            md5.update(chunk)
+            size += len(chunk)
+    return size // (channels * bits // 8), md5.hexdigest()
+
+
+def main():
+    args = docopt(__doc__)
+    chunk_duration = float(args['--chunk-duration'])
+    processes = int(args['--processes'])
+    if FFMPEG is None or PROBE is None or not format_codec_map['FLAC']:
+        sys.exit('FFmpeg, FFprobe and a FLAC encoder are needed')
+    encoder = format_codec_map['FLAC'][0]
+    formats = [Format.fromstring(raw.strip()) for raw in args['--formats'].upper().split(',')]
+
+    matched = True
+    print('{:<24} {:<16} {:>12} {:>6} {:>10} {:>9} {:>9}'.format(
+        'Source', 'Format', 'Samples', 'MD5', 'STREAMINFO', 'Whole s', 'Chunked s'))
+    for source, fmt in [(source, fmt) for source in args['<source>'] for fmt in formats]:
+        source = os.path.abspath(source)
+        template = TranscodeTemplate(FFMPEG, encoder, Format(fmt.type, fmt.subtype, args['--profile']))
+        stream = PROBE.probe(source)
+        if not chunkable(template, stream, chunk_duration):
+            print('{:<24} {:<16} encoded whole'.format(os.path.basename(source)[:24], str(fmt)))
+            continue
+        duration = stream['duration']
+        with tempfile.TemporaryDirectory() as tempdir:
+            whole_dir, chunked_dir = os.path.join(tempdir, 'whole'), os.path.join(tempdir, 'chunked')
+            whole_time, whole_ok = run([transcode_task(template, source, whole_dir, 'output')], processes)
+            chunked_time, chunked_ok = run(chunked_tasks(template, source, chunked_dir, 'output',
+                                                         duration, chunk_duration), processes)
+            if not (whole_ok and chunked_ok):
+                print('{:<24} {:<16} failed to encode'.format(os.path.basename(source)[:24], str(fmt)))
+                matched = False
+                continue
+            whole = decoded(os.path.join(whole_dir, 'output.flac'))
+            joined_path = os.path.join(chunked_dir, 'output.flac')
+            joined = decoded(joined_path)
+            _channels, _bits, total_samples, md5 = streaminfo(joined_path)
+        samples_match = whole[0] == joined[0]
+        md5_match = whole[1] == joined[1]
+        info_match = (total_samples, md5) == joined
+        matched = matched and samples_match and md5_match and info_match
+        print('{:<24} {:<16} {:>12} {:>6} {:>10} {:9.2f} {:9.2f}'.format(
+            os.path.basename(source)[:24], str(fmt),
+            joined[0] if samples_match else '{}!={}'.format(joined[0], whole[0]),
+            'ok' if md5_match else 'DIFFER', 'ok' if info_match else 'WRONG',
+            whole_time, chunked_time))
+    sys.exit(0 if matched else 1)
+
+
+if __name__ == '__main__':
+    main()
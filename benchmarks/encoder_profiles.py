@@ -0,0 +1,103 @@
+"""Encoder profile benchmark
+
+Encodes sources to each format at each effort profile, by the codec OATS
+would use for the format on this system, and reports the time taken, the
+speed as a multiple of realtime, and the size of the outputs against that of
+the archival profile. Sources are decoded to wav once beforehand, so that
+only the encodes are timed. Each encode is given one thread, as when OATS has
+more work queued than processes.
+
+Usage:
+  encoder_profiles.py [options] <source> ...
+
+Options:
+  -f --formats=<fmt-list>  The formats to encode to [default: MP3 VBR 0,MP3 CBR 320,FLAC,OPUS VBR 128,VORBIS VBR 5].
+  -r --repeat=<count>      Encode each source this many times, keeping the fastest [default: 1].
+  -h --help                Show this screen.
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from oats import codec
+from oats.script import FFMPEG, Format, format_codec_map
+
+
+def run(command):
+    subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL, check=True)
+
+
+def wav_duration(path):
+    with wave.open(path, 'rb') as wav:
+        return wav.getnframes() / wav.getframerate()
+
+
+def encode(template, wavfile, outfile, repeat):
+    """Encode a wav file, returning the fastest time taken and the size of the output"""
+    best = None
+    for _ in range(repeat):
+        if os.path.exists(outfile):
+            os.remove(outfile)
+        start = time.perf_counter()
+        run(template.command(wavfile, outfile))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    size = os.path.getsize(outfile)
+    os.remove(outfile)
+    return best, size
+
+
+def main():
+    args = docopt(__doc__)
+    repeat = int(args['--repeat'])
+    formats = [Format.fromstring(raw.strip()) for raw in args['--formats'].upper().split(',')]
+    if FFMPEG is None:
+        sys.exit('FFmpeg is needed to decode the sources')
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        wavs = {}  # (source, requirements) -> (wav file, duration)
+
+        def decoded(source, requires):
+            key = (source, tuple(sorted(requires.items())))
+            if key not in wavs:
+                wavfile = os.path.join(tempdir, '{}.wav'.format(len(wavs)))
+                run(FFMPEG.decode(source, wavfile, **requires))
+                wavs[key] = (wavfile, wav_duration(wavfile))
+            return wavs[key]
+
+        print('{:<16} {:<12} {:<9} {:>9} {:>11} {:>9} {:>7}'.format(
+            'Format', 'Codec', 'Profile', 'Seconds', 'x realtime', 'MiB', 'Size'))
+        for fmt in formats:
+            if not format_codec_map.get(fmt.type):
+                print('{:<16} no codec on this system'.format(str(fmt)))
+                continue
+            encoder = format_codec_map[fmt.type][0]
+            #Codecs without an effort setting encode alike at every profile
+            profiles = codec.PROFILES if encoder.efforts else (codec.DEFAULT_PROFILE,)
+            rows = []
+            for profile in profiles:
+                template = encoder.compile(fmt.subtype, profile)
+                elapsed, size, duration = 0.0, 0, 0.0
+                for source in args['<source>']:
+                    wavfile, seconds = decoded(source, dict(template.requires))
+                    outfile = os.path.join(tempdir, 'output' + encoder.extension)
+                    took, made = encode(template, wavfile, outfile, repeat)
+                    elapsed, size, duration = elapsed + took, size + made, duration + seconds
+                rows.append((profile, elapsed, size, duration))
+            archival = rows[-1][2]
+            for profile, elapsed, size, duration in rows:
+                print('{:<16} {:<12} {:<9} {:9.2f} {:11.1f} {:9.2f} {:6.1f}%'.format(
+                    str(fmt), encoder.__name__, profile, elapsed, duration / elapsed,
+                    size / 2**20, 100.0 * size / archival))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Task generation benchmark
+
+Times the generation of the transcode tasks of many files, and the
+composition of their encode commands as the engine runs them, with the format
+compiled once against parsing and validating it for every file. Also reports
+the memory held by each queued task. No files are read or written and no
+tools are run, so any codec may be benchmarked.
+
+Usage:
+  task_generation.py [options]
+
+Options:
+  -n --files=<count>     The number of files to generate tasks for [default: 1000000].
+  -e --encoder=<codec>   The codec class encoding the format [default: LAME].
+  -f --format=<format>   The format to encode to [default: VBR 0].
+  -h --help              Show this screen.
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from oats import codec
+from oats.script import Format, TranscodeTemplate, transcode_task
+
+#Tasks held in memory at once to measure their size
+MEMORY_SAMPLE = 100000
+
+
+def paths(count):
+    """Yield the source, destination directory and name of each synthetic file"""
+    for i in range(count):
+        album = '/music/Artist {:05d} - Album [FLAC]'.format(i // 12)
+        name = '{:02d} - Track Title'.format(i % 12 + 1)
+        yield os.path.join(album, name + '.flac'), album.replace('/music/', '/transcodes/'), name
+
+
+def parsed_every_time(encoder, fmt, wavfile, outfile):
+    """The encode command of a file, parsing and validating the format as before"""
+    words = [w.upper() for w in fmt.split()]
+    encoder._encode_requires(words)
+    return codec.EncodeTemplate(encoder, fmt, codec.DEFAULT_PROFILE,
+                                tuple(encoder._compile(words, codec.DEFAULT_PROFILE)), {}).command(wavfile, outfile)
+
+
+def timed(label, count, function):
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    print('{:<40} {:8.2f} s  {:8.2f} us/file'.format(label, elapsed, elapsed / count * 1e6))
+    return elapsed
+
+
+def main():
+    args = docopt(__doc__)
+    count = int(args['--files'])
+    encoder = getattr(codec, args['--encoder'])
+    fmt = Format(encoder.__name__, args['--format'])
+    template = TranscodeTemplate(codec.FFmpeg, encoder, fmt)
+    print('{} tasks of {} by {}'.format(count, fmt.subtype, encoder.__name__))
+
+    def generate():
+        for source, dest_dir, name in paths(count):
+            transcode_task(template, source, dest_dir, name)
+
+    def compose_compiled():
+        for source, dest_dir, name in paths(count):
+            dest = os.path.join(dest_dir, name + encoder.extension)
+            template.encode.command(dest[:-4] + '.wav', dest)
+
+    def compose_parsed():
+        for source, dest_dir, name in paths(count):
+            dest = os.path.join(dest_dir, name + encoder.extension)
+            parsed_every_time(encoder, fmt.subtype, dest[:-4] + '.wav', dest)
+
+    def compose_all():
+        for source, dest_dir, name in paths(count):
+            #The decode command is not called, as it makes the destination directory
+            for command in transcode_task(template, source, dest_dir, name).all_commands():
+                if getattr(command, 'func', None) == template.encode.command:
+                    command(threads=1)
+
+    baseline = timed('Walking synthetic paths', count, lambda: sum(1 for _ in paths(count)))
+    timed('Generating tasks', count, generate)
+    compiled = timed('Encode commands, compiled format', count, compose_compiled)
+    parsed = timed('Encode commands, format parsed per file', count, compose_parsed)
+    timed('Generating and composing every command', count, compose_all)
+    print('Compiled encode commands are {:.1f}x faster to compose'.format(
+        (parsed - baseline) / max(compiled - baseline, 1e-9)))
+
+    sample = min(count, MEMORY_SAMPLE)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tasks = [transcode_task(template, source, dest_dir, name) for source, dest_dir, name in paths(sample)]
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print('Each queued task holds {:.0f} bytes, paths included'.format(held / len(tasks)))
+
+
+if __name__ == '__main__':
+    main()
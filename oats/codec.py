@@ -1,7 +1,15 @@
+import json
 import os
 import platform
 import subprocess
 import shlex
+from collections import namedtuple
+from types import MappingProxyType
+
+#Encoder effort profiles, from the quickest to encode to the most thorough. Each
+#codec maps them onto its own speed and compression settings (Codec.efforts).
+PROFILES = ('fast', 'balanced', 'archival')
+DEFAULT_PROFILE = 'archival'
 
 def sane_int(valstr, valname, minval=None, maxval=None, permitted=None):
     try:
@@ -33,12 +41,60 @@ def sane_float(valstr, valname, minval=None, maxval=None):
     return valflt
 
 
+class Placeholder(object):
+    """
+    A stand-in within a compiled encode command for arguments only known
+    when it is run, expanded by a function of the wav file, output file and
+    thread count into the arguments it stands for.
+    """
+    __slots__ = ('name', 'expand')
+
+    def __init__(self, name, expand):
+        self.name = name
+        self.expand = expand
+
+    def __repr__(self):
+        return '<{}>'.format(self.name)
+
+WAVFILE = Placeholder('wavfile', lambda wavfile, outfile, threads: [wavfile])
+OUTFILE = Placeholder('outfile', lambda wavfile, outfile, threads: [outfile])
+THREADS = Placeholder('threads', lambda wavfile, outfile, threads: [str(threads)])
+
+
+class EncodeTemplate(namedtuple('EncodeTemplate', ['codec', 'fmt', 'profile', 'argv', 'requires'])):
+    """
+    The encode command of a format by a codec at an effort profile, parsed
+    and validated once (see Codec.compile). `argv` holds the arguments of the command with
+    Placeholders for those of each task, and `requires` is the read-only
+    mapping of the parameters the wav file must have (see
+    Codec.encode_requires).
+    """
+    __slots__ = ()
+
+    def command(self, wavfile, outfile, threads=1):
+        """Compose the command encoding a wav file to an output file"""
+        command = []
+        for arg in self.argv:
+            if arg.__class__ is str:
+                command.append(arg)
+            else:
+                command += arg.expand(wavfile, outfile, threads)
+        return command
+
+
 class Codec(object):
     """
     Codec is the base class for the Coder/Decoder tools for OATS.
     """
     depends = '<tool>'  # This should correspond to the command invocation for the underlying tool.
     extension = ''      # The file extension associated with the codec type.
+    passthrough_codec = None  # Source codec name that may be copied rather than transcoded.
+    seekable = False    # Whether decode supports the start and end of a time range.
+    concatenable = False  # Whether separately encoded segments join losslessly with flacjoin.join.
+    version_args = ['--version']  # Arguments making the tool print its version.
+    efforts = {}        # Profile -> the codec's effort setting, if it has one.
+    _compiled = {}  # (codec, format string, profile) -> EncodeTemplate
+    _versions = {}  # tool -> version
 
     @classmethod
     def on_system(cls):
@@ -57,21 +113,66 @@ class Codec(object):
             return True
 
     @classmethod
-    def encode(cls, wavfile, outfile, fmt):
+    def version(cls):
+        """
+        The first line printed by the tool of its version, identifying the
+        build which made an output, or an empty string if it cannot be run.
+        """
+        if cls.depends not in Codec._versions:
+            try:
+                output = subprocess.check_output([cls.depends] + cls.version_args,
+                                                 stdin=subprocess.DEVNULL,
+                                                 stderr=subprocess.STDOUT)
+                lines = output.decode('utf-8', errors='replace').strip().splitlines()
+            except (subprocess.CalledProcessError, OSError):
+                lines = []
+            Codec._versions[cls.depends] = lines[0] if lines else ''
+        return Codec._versions[cls.depends]
+
+    @classmethod
+    def encode(cls, wavfile, outfile, fmt, threads=1, profile=DEFAULT_PROFILE):
         """
         The encode method expects a filepath to a wavfile, a format string to
         determine encoding options, and a filepath for the encoded output.
 
-        The format string will be used in most but not all cases.
+        The format string will be used in most but not all cases. The threads
+        value is the number of threads the task may use, tools which cannot
+        make use of more than one will ignore it. The profile is one of
+        PROFILES, trading the time taken to encode against the size or
+        quality of the output.
+        """
+        return cls.compile(fmt, profile).command(wavfile, outfile, threads)
+
+    @classmethod
+    def compile(cls, fmt, profile=DEFAULT_PROFILE):
+        """
+        Parse and validate a format string once, returning the EncodeTemplate
+        of its encode command at the effort profile. Templates are cached, so
+        that each encode is only a substitution of paths into the template.
+        Raises ValueError if the format or profile is not valid for the codec.
         """
-        return cls._encode(wavfile, outfile, [w.upper() for w in fmt.split(' ')])
+        template = Codec._compiled.get((cls, fmt, profile))
+        if template is None:
+            if profile not in PROFILES:
+                raise ValueError("unknown profile '{}', expected one of {}".format(profile, ', '.join(PROFILES)))
+            words = [w.upper() for w in fmt.split()]
+            template = EncodeTemplate(cls, fmt, profile, tuple(cls._compile(words, profile)),
+                                      MappingProxyType(cls._encode_requires(words)))
+            Codec._compiled[(cls, fmt, profile)] = template
+        return template
 
     @classmethod
-    def _encode(cls, wavfile, outfile, fmt):
+    def _compile(cls, fmt, profile):
+        """
+        Return the arguments of the encode command of a format, given as a
+        list of upper case words, with the Placeholders WAVFILE, OUTFILE and
+        THREADS in place of the arguments of each task. The effort setting
+        of the profile is `cls.efforts[profile]`.
+        """
         raise NotImplementedError
 
     @classmethod
-    def decode(cls, inputfile, wavfile, bit_depth=None, sample_rate=None):
+    def decode(cls, inputfile, wavfile, bit_depth=None, sample_rate=None, start=None, end=None, threads=1):
         raise NotImplementedError
 
     @classmethod
@@ -82,23 +183,90 @@ class Codec(object):
         keys in this dictionary are 'bit_depth' and 'sample_rate'. If there are
         no requirements, returns an empty dictionary.
         """
-        return cls._encode_requires([w.upper() for w in fmt.split(' ')])
+        return dict(cls.compile(fmt).requires)
 
     @classmethod
     def _encode_requires(cls, fmt):
         return {}
 
+    @classmethod
+    def passthrough(cls, stream, fmt):
+        """
+        Passing the stream information of a source (as produced by
+        FFprobe.probe) and a format to this method will return True if the
+        source already satisfies the format, so that it may be copied or
+        remuxed instead of transcoded.
+        """
+        if cls.passthrough_codec is None or stream is None:
+            return False
+        if stream.get('codec') != cls.passthrough_codec:
+            return False
+        for key, value in cls.encode_requires(fmt).items():
+            if stream.get(key) != value:
+                return False
+        return True
+
+
+class FFprobe(Codec):
+    """
+    The FFprobe class provides stream inspection of source files.
+    """
+    depends = 'ffprobe'
+
+    @classmethod
+    def probe(cls, inputfile):
+        """
+        Return a dictionary describing the first audio stream of the input
+        file, with keys 'codec', 'bit_depth', 'sample_rate', 'channels' and
+        'duration'. Returns None if the file could not be inspected.
+        """
+        command = ['ffprobe', '-v', 'error', '-select_streams', 'a:0',
+                   '-show_entries',
+                   'stream=codec_name,sample_rate,channels,bits_per_raw_sample,bits_per_sample,duration',
+                   '-of', 'json', inputfile]
+        try:
+            output = subprocess.check_output(command,
+                                             stdin=subprocess.DEVNULL,
+                                             stderr=subprocess.DEVNULL)
+            streams = json.loads(output.decode('utf-8'))['streams']
+        except (subprocess.CalledProcessError, ValueError, KeyError):
+            return None
+        if not streams:
+            return None
+        stream = streams[0]
+
+        def field(key, kind=int):
+            try:
+                value = kind(stream[key])
+            except (KeyError, ValueError):
+                return None
+            return value or None
+
+        return {'codec': stream.get('codec_name'),
+                'bit_depth': field('bits_per_raw_sample') or field('bits_per_sample'),
+                'sample_rate': field('sample_rate'),
+                'channels': field('channels'),
+                'duration': field('duration', float)}
+
 
 class FFmpeg(Codec):
     """
     The FFmpeg class provides a basic decoder implementation.
     """
     depends = 'ffmpeg'
+    version_args = ['-version']
     template = ''
+    seekable = True
 
     @classmethod
-    def decode(cls, inputfile, wavfile, bit_depth=None, sample_rate=None):
-        command = ['ffmpeg', '-threads', '1', '-i', inputfile]
+    def decode(cls, inputfile, wavfile, bit_depth=None, sample_rate=None, start=None, end=None, threads=1):
+        command = ['ffmpeg', '-threads', str(threads)]
+        #Input seeking is sample accurate for audio when decoding
+        if start is not None:
+            command += ['-ss', '{:.6f}'.format(start)]
+        if end is not None:
+            command += ['-t', '{:.6f}'.format(end - (start or 0))]
+        command += ['-i', inputfile]
         if bit_depth is not None:
             bitdepthmap = {8: 'pcm_s8le', 16: 'pcm_s16le', 24: 'pcm_s24le', 32: 'pcm_s32le'}
             command += ['-c:a', bitdepthmap[bit_depth]]
@@ -108,6 +276,26 @@ class FFmpeg(Codec):
         command += [wavfile]
         return command
 
+    @classmethod
+    def remux(cls, inputfile, outfile, threads=1):
+        """
+        Copy the audio stream of the input into the container of the output
+        without transcoding, keeping the metadata of the input.
+        """
+        return ['ffmpeg', '-threads', str(threads), '-i', inputfile,
+                '-map', '0:a', '-map_metadata', '0', '-c:a', 'copy', outfile]
+
+    @classmethod
+    def md5(cls, inputfile, outfile, bit_depth, threads=1):
+        """
+        Write the MD5 of the decoded audio of the input to the output file, as
+        hashed by FLAC encoders: signed little-endian samples of the given
+        bit depth.
+        """
+        bitdepthmap = {8: 'pcm_s8', 16: 'pcm_s16le', 24: 'pcm_s24le', 32: 'pcm_s32le'}
+        return ['ffmpeg', '-threads', str(threads), '-i', inputfile, '-map', '0:a',
+                '-c:a', bitdepthmap[bit_depth], '-f', 'md5', outfile]
+
 
 class LAME(Codec):
     depends = 'lame'
@@ -118,10 +306,14 @@ class LAME(Codec):
                  'ABR {bitrate;kbps:8-320}',
                  'VBR {quality:0-9}']
     extension = '.mp3'
+    #The -q algorithm quality: 0 is the slowest, 2 is recommended by LAME as
+    #near the best, and 5 is its default. Beyond 5, VBR bitrates and quality
+    #drop, rather than only the effort of the encoder.
+    efforts = {'fast': '5', 'balanced': '2', 'archival': '0'}
 
     @classmethod
-    def _encode(cls, wavfile, outfile, fmt):
-        constants = ['-q', '0', '--noreplaygain']
+    def _compile(cls, fmt, profile):
+        constants = ['-q', cls.efforts[profile], '--noreplaygain']
         #Valid format checks
         if fmt[0] not in ['VBR', 'CBR', 'ABR']:
             raise ValueError("LAME expects a format type of CBR, ABR, or VBR: '{}'".format(fmt[0]))
@@ -131,22 +323,24 @@ class LAME(Codec):
         if fmt[0] == 'CBR':
             bitrate = sane_int(fmt[1], 'LAME CBR bitrate',
                                minval=8, maxval=320)
-            return ['lame', '--cbr', '-b', str(bitrate)] + constants + [wavfile, outfile]
+            return ['lame', '--cbr', '-b', str(bitrate)] + constants + [WAVFILE, OUTFILE]
         elif fmt[0] == 'ABR':
             bitrate = sane_int(fmt[1], 'LAME ABR bitrate',
                                minval=8, maxval=320)
-            return ['lame', '--abr', str(bitrate)] + constants + [wavfile, outfile]
+            return ['lame', '--abr', str(bitrate)] + constants + [WAVFILE, OUTFILE]
         elif fmt[0] == 'VBR':
             quality = sane_int(fmt[1], 'LAME VBR quality',
                                minval=0, maxval=9)
-            return ['lame', '-V'+str(quality), '--vbr-new', '-T'] + constants + [wavfile, outfile]
+            return ['lame', '-V'+str(quality), '--vbr-new', '-T'] + constants + [WAVFILE, OUTFILE]
 
     @classmethod
-    def decode(cls, inputfile, wavfile, bit_depth=None, sample_rate=None):
+    def decode(cls, inputfile, wavfile, bit_depth=None, sample_rate=None, start=None, end=None, threads=1):
         if bit_depth is not None:
             raise ValueError('bit depth decode control not supported by LAME')
         if sample_rate is not None:
             raise ValueError('sample rate decode control not supported by LAME')
+        if start is not None or end is not None:
+            raise ValueError('time range decode control not supported by LAME')
         command = ['lame', '--decode', inputfile, wavfile]
         return command
 
@@ -159,12 +353,13 @@ class FFmpegMP3(FFmpeg):
                  'ABR {bitrate;kbps:8-320}',
                  'VBR {quality:0-9}']
     extension='.mp3'
+    #The compression level of libmp3lame is the -q of LAME
+    efforts = LAME.efforts
 
     @classmethod
-    def _encode(cls, wavfile, outfile, fmt):
-        head = ['ffmpeg', '-threads', '1', '-i', wavfile]
-        #0 is the slowest, highest quality compression for libmp3lame
-        tail = ['-compression_level', '0', outfile]
+    def _compile(cls, fmt, profile):
+        head = ['ffmpeg', '-threads', THREADS, '-i', WAVFILE, '-threads', THREADS]
+        tail = ['-compression_level', cls.efforts[profile], OUTFILE]
         #Valid format checks
         if fmt[0] not in ['VBR', 'CBR', 'ABR']:
             raise ValueError("FFmpegMP3 expects a format type of CBR, ABR, or VBR: '{}'".format(fmt[0]))
@@ -193,13 +388,17 @@ class FFmpegFLAC(FFmpeg):
     #Common sample rates: 44100, 44000, 88000, 96000
     #bit depths: 8, 16, 24, 32
     extension='.flac'
+    passthrough_codec = 'flac'
+    concatenable = True
     #http://ffmpeg.org/ffmpeg-resampler.html
+    #12 is the slowest compression level giving the smallest files. Levels
+    #below 3 are no quicker, their larger files taking as long to write.
+    efforts = {'fast': '3', 'balanced': '8', 'archival': '12'}
 
     @classmethod
-    def _encode(cls, wavfile, outfile, fmt):
-        #12 is the slowest, highest quality compression for flac
-        return ['ffmpeg', '-threads', '1', '-i', wavfile,
-                '-c:a', 'flac', '-compression_level', '12', outfile]
+    def _compile(cls, fmt, profile):
+        return ['ffmpeg', '-threads', THREADS, '-i', WAVFILE, '-threads', THREADS,
+                '-c:a', 'flac', '-compression_level', cls.efforts[profile], OUTFILE]
 
     @classmethod
     def _encode_requires(cls, fmt):
@@ -216,6 +415,59 @@ class FFmpegFLAC(FFmpeg):
         return retdict
 
 
+#The thread count option of the flac tool, only given for more than one thread
+JOBS = Placeholder('jobs', lambda wavfile, outfile, threads: ['-j', str(threads)] if threads > 1 else [])
+
+
+class FlacTools(Codec):
+    depends = 'flac'
+    formats = ['\d+[ \-]\d+']
+    templates = ['',
+                 '{bit_depth:8,16,24,32,*} {sample_rate;Hz}']
+    extension = '.flac'
+    passthrough_codec = 'flac'
+    concatenable = True
+    #-8 is the slowest compression level giving the smallest files, -5 the default
+    efforts = {'fast': '-3', 'balanced': '-5', 'archival': '-8'}
+    _multithreaded = None
+
+    @classmethod
+    def on_system(cls):
+        #The flac tool is only preferred over FFmpeg where it may encode with
+        #multiple threads
+        return super().on_system() and cls.multithreaded()
+
+    @classmethod
+    def multithreaded(cls):
+        """
+        Multithreaded encoding (-j) arrived in flac 1.5.0, so check once if
+        the installed version understands it.
+        """
+        if cls._multithreaded is None:
+            try:
+                output = subprocess.check_output(['flac', '--version'],
+                                                 stdin=subprocess.DEVNULL,
+                                                 stderr=subprocess.DEVNULL)
+                version = output.decode('utf-8').split()[-1]
+                major, minor = [int(v) for v in version.split('.')[:2]]
+            except (subprocess.CalledProcessError, OSError, ValueError, IndexError):
+                cls._multithreaded = False
+            else:
+                cls._multithreaded = (major, minor) >= (1, 5)
+        return cls._multithreaded
+
+    @classmethod
+    def _compile(cls, fmt, profile):
+        command = ['flac', '--silent', '--force', cls.efforts[profile]]
+        if cls.multithreaded():
+            command += [JOBS]
+        return command + ['-o', OUTFILE, WAVFILE]
+
+    @classmethod
+    def _encode_requires(cls, fmt):
+        return FFmpegFLAC._encode_requires(fmt)
+
+
 class FFmpegOpus(FFmpeg):
     formats = ['CBR \d+',
                'VBR \d+',
@@ -226,10 +478,12 @@ class FFmpegOpus(FFmpeg):
                  'CVBR {bitrate;kbps:8-512}',
                  ]
     extension = '.opus'
+    #The encoder complexity: 10 is the slowest and highest quality
+    efforts = {'fast': '3', 'balanced': '6', 'archival': '10'}
 
     @classmethod
-    def _encode(cls, wavfile, outfile, fmt):
-        head = ['ffmpeg', '-threads', '1', '-i', wavfile, '-c:a', 'libopus']
+    def _compile(cls, fmt, profile):
+        head = ['ffmpeg', '-threads', THREADS, '-i', WAVFILE, '-threads', THREADS, '-c:a', 'libopus']
         br_types = {'CBR' : ['-vbr', 'off', '-b:a'],
                     'VBR' : ['-vbr', 'on', '-b:a'],
                     'CVBR': ['-vbr', 'constrained', '-b:a']
@@ -242,8 +496,7 @@ class FFmpegOpus(FFmpeg):
         #If checks passed, continue to return command lists
         bitrate = sane_int(fmt[1], 'FFmpegOpus bitrate', minval=8, maxval=512)
         br_type = br_types[fmt[0]]
-        #10 is the slowest, highest quality compression for opusenc
-        return head + br_type + ['{}k'.format(bitrate), '-compresson_level', '10', outfile]
+        return head + br_type + ['{}k'.format(bitrate), '-compression_level', cls.efforts[profile], OUTFILE]
 
 
 class OpusTools(Codec):
@@ -257,9 +510,10 @@ class OpusTools(Codec):
                  'CVBR {bitrate;kbps:8-512}',
                  ]
     extension = '.opus'
+    efforts = FFmpegOpus.efforts
 
     @classmethod
-    def _encode(cls, wavfile, outfile, fmt):
+    def _compile(cls, fmt, profile):
         br_types = {'CBR': '--hard-cbr', 'VBR': '--vbr', 'CVBR': '--cvbr'}
         #Valid format checks
         if fmt[0] not in br_types:
@@ -269,16 +523,17 @@ class OpusTools(Codec):
         #If checks passed, continue to return command lists
         bitrate = sane_int(fmt[1], 'OpusTools bitrate', minval=8, maxval=512)
         br_type = br_types[fmt[0]]
-        #10 is the slowest, highest quality compression for opusenc
-        return ['opusenc', '--bitrate', str(bitrate), '--comp', '10', br_type, wavfile, outfile]
+        return ['opusenc', '--bitrate', str(bitrate), '--comp', cls.efforts[profile], br_type, WAVFILE, OUTFILE]
 
     @classmethod
-    def decode(cls, inputfile, wavfile, bit_depth=None, sample_rate=None):
+    def decode(cls, inputfile, wavfile, bit_depth=None, sample_rate=None, start=None, end=None, threads=1):
         command = ['opusdec']
         if sample_rate is not None:
             command += ['--rate', str(sample_rate)]
         if bit_depth is not None:
             raise ValueError('bit depth decode control not supported by opusdec')
+        if start is not None or end is not None:
+            raise ValueError('time range decode control not supported by opusdec')
         command += [inputfile, wavfile]
         return command
 
@@ -292,23 +547,24 @@ class FFmpegVorbis(FFmpeg):
                  'ABR {bitrate;kbps:45-500}',
                  'MANAGED [MAX{max-bitrate;kbps:>=1}] [MIN{min-bitrate;kbps:>=1}] [B{bitrate;kbps:45-500}]']
     extension = '.vorbis'
+    #libvorbis has no setting trading speed for quality, so profiles have no effect
 
     @classmethod
-    def _encode(cls, wavfile, outfile, fmt):
+    def _compile(cls, fmt, profile):
         br_types = {'ABR', 'VBR', 'MANAGED'}
-        head = ['ffmpeg', '-threads', '1', '-i', wavfile, '-vn', '-c:a', 'libvorbis', '-f', 'ogg']
+        head = ['ffmpeg', '-threads', THREADS, '-i', WAVFILE, '-threads', THREADS, '-vn', '-c:a', 'libvorbis', '-f', 'ogg']
         if fmt[0] not in br_types:
             raise ValueError("FFmpegVorbis expects a format type of {}: '{}'".format(', '.join(br_types), fmt[0]))
         if fmt[0] == 'VBR':
             if len(fmt) != 2:
                 raise ValueError("FFmpegVorbis expects a quality value for VBR: '{}'".format(' '.join(fmt)))
             quality = sane_float(fmt[1], 'FFmpegVorbis quality', minval=-1.0, maxval=10)
-            return head + ['-q', str(quality), outfile]
+            return head + ['-q', str(quality), OUTFILE]
         elif fmt[0] == 'ABR':
             if len(fmt) != 2:
                 raise ValueError("FFmpegVorbis expects a bitrate value for ABR: '{}'".format(' '.join(fmt)))
             bitrate = sane_int(fmt[1], 'FFmpegVorbis average bitrate', minval=45, maxval=500)
-            return head + ['-b', str(bitrate), outfile]
+            return head + ['-b', str(bitrate), OUTFILE]
         elif fmt[0] == 'MANAGED':
             command = head
             maxbitrate, minbitrate, bitrate = None, None, None
@@ -338,7 +594,7 @@ class FFmpegVorbis(FFmpeg):
                 command += ['-minrate', str(minbitrate)]
             if bitrate is not None:
                 command += ['-b:a', str(bitrate)]
-            return command + [wavfile]
+            return command + [OUTFILE]
 
 
 class OggVorbis(Codec):
@@ -350,9 +606,10 @@ class OggVorbis(Codec):
                  'ABR {bitrate;kbps:45-500}',
                  'MANAGED [MAX{max-bitrate;kbps:>=1}] [MIN{min-bitrate;kbps:>=1}] [B{bitrate;kbps:45-500}]']
     extension = '.vorbis'
+    #libvorbis has no setting trading speed for quality, so profiles have no effect
 
     @classmethod
-    def _encode(cls, wavfile, outfile, fmt):
+    def _compile(cls, fmt, profile):
         br_types = {'ABR', 'VBR', 'MANAGED'}
         if fmt[0] not in br_types:
             raise ValueError("OggVorbis expects a format type of {}: '{}'".format(', '.join(br_types), fmt[0]))
@@ -360,14 +617,14 @@ class OggVorbis(Codec):
             if len(fmt) != 2:
                 raise ValueError("OggVorbis expects a quality value for VBR: '{}'".format(' '.join(fmt)))
             quality = sane_float(fmt[1], 'OggVorbis quality', minval=-1.0, maxval=10)
-            return ['oggenc', '-q', str(quality), '-o', outfile, wavfile]
+            return ['oggenc', '-q', str(quality), '-o', OUTFILE, WAVFILE]
         elif fmt[0] == 'ABR':
             if len(fmt) != 2:
                 raise ValueError("OggVorbis expects a bitrate value for ABR: '{}'".format(' '.join(fmt)))
             bitrate = sane_int(fmt[1], 'OggVorbis average bitrate', minval=45, maxval=500)
-            return ['oggenc', '-b', str(bitrate), '-o', outfile, wavfile]
+            return ['oggenc', '-b', str(bitrate), '-o', OUTFILE, WAVFILE]
         elif fmt[0] == 'MANAGED':
-            command = ['oggenc', '--managed', '-o', outfile]
+            command = ['oggenc', '--managed', '-o', OUTFILE]
             maxbitrate, minbitrate, bitrate = None, None, None
             for word in fmt[1:]:
                 if word.startswith('MAX'):
@@ -395,10 +652,10 @@ class OggVorbis(Codec):
                 command += ['--min-bitrate', str(minbitrate)]
             if bitrate is not None:
                 command += ['-b', str(bitrate)]
-            return command + [wavfile]
+            return command + [WAVFILE]
 
     @classmethod
-    def decode(cls, inputfile, wavfile, bit_depth=None, sample_rate=None):
+    def decode(cls, inputfile, wavfile, bit_depth=None, sample_rate=None, start=None, end=None, threads=1):
         command = ['oggdec']
         if sample_rate is not None:
             ValueError('sample rate decode control not supported by oggdec')
@@ -407,5 +664,7 @@ class OggVorbis(Codec):
                 raise ValueError('oggdec bit depth decode control only supports 8 or 16 bit')
             else:
                 command += ['-b', str(bit_depth)]
+        if start is not None or end is not None:
+            raise ValueError('time range decode control not supported by oggdec')
         command += ['-o', wavfile, inputfile]
         return command
@@ -0,0 +1,202 @@
+"""
+CUE sheet parsing for OATS
+"""
+
+import os
+import re
+
+#CUE sheet timestamps are minutes:seconds:frames with 75 frames per second
+FRAMES_PER_SECOND = 75
+
+COMMAND_REGEX = re.compile(r'^\s*(?P<command>[A-Za-z]+)\s*(?P<value>.*?)\s*$')
+FILE_REGEX = re.compile(r'^(?:"(?P<quoted>.*)"|(?P<bare>\S+))(\s+(?P<type>\S+))?$')
+INDEX_REGEX = re.compile(r'^(?P<number>\d+)\s+(?P<m>\d+):(?P<s>\d+):(?P<f>\d+)$')
+
+#Characters which may not appear in file names on common filesystems
+UNSAFE_FILENAME_REGEX = re.compile(r'[\\/:*?"<>|\x00-\x1f]')
+
+
+class CueTrack(object):
+    """A single track of a CUE sheet, spanning [start, end) of its file."""
+    def __init__(self, number):
+        self.number = number
+        self.title = None
+        self.performer = None
+        self.songwriter = None
+        self.isrc = None
+        self.start = None  # In seconds, from INDEX 01
+        self.end = None    # In seconds, None if the track runs to the end of the file
+
+    def name(self):
+        """Compose the output file name of the track, without extension."""
+        if self.title:
+            title = UNSAFE_FILENAME_REGEX.sub('_', self.title).strip(' .')
+        else:
+            title = ''
+        if not title:
+            title = 'Track {:02d}'.format(self.number)
+        return '{:02d} - {}'.format(self.number, title)
+
+
+class CueFile(object):
+    """A FILE entry of a CUE sheet, and the tracks it contains."""
+    def __init__(self, name, filetype):
+        self.name = name
+        self.filetype = filetype
+        self.tracks = []
+
+
+class CueSheet(object):
+    def __init__(self):
+        self.title = None
+        self.performer = None
+        self.songwriter = None
+        self.rem = {}
+        self.files = []
+
+    def tags(self, track):
+        """
+        Return the tags of a track as a dictionary of EasyID3 style keys and
+        string values.
+        """
+        tags = {'tracknumber': '{}/{}'.format(track.number, self.track_count())}
+        if track.title:
+            tags['title'] = track.title
+        if track.performer or self.performer:
+            tags['artist'] = track.performer or self.performer
+        if self.performer:
+            tags['albumartist'] = self.performer
+        if self.title:
+            tags['album'] = self.title
+        if track.songwriter or self.songwriter:
+            tags['composer'] = track.songwriter or self.songwriter
+        if track.isrc:
+            tags['isrc'] = track.isrc
+        if 'DATE' in self.rem:
+            tags['date'] = self.rem['DATE']
+        if 'GENRE' in self.rem:
+            tags['genre'] = self.rem['GENRE']
+        if 'DISCNUMBER' in self.rem:
+            tags['discnumber'] = self.rem['DISCNUMBER']
+        return tags
+
+    def track_count(self):
+        return sum(len(f.tracks) for f in self.files)
+
+
+def parse_timestamp(value):
+    """Convert a mm:ss:ff CUE timestamp into seconds."""
+    minutes, seconds, frames = [int(v) for v in value.split(':')]
+    return (minutes * 60 + seconds) + frames / FRAMES_PER_SECOND
+
+
+def unquote(value):
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        return value[1:-1]
+    return value
+
+
+def parse_cue(text):
+    """
+    Parse the text of a CUE sheet into a CueSheet. Tracks are delimited by
+    their INDEX 01 positions, so any pregap belongs to the preceding track.
+    """
+    sheet = CueSheet()
+    current_file = None
+    current_track = None
+    for line in text.splitlines():
+        match = COMMAND_REGEX.match(line)
+        if match is None:
+            continue
+        command = match.group('command').upper()
+        value = match.group('value')
+
+        if command == 'FILE':
+            file_match = FILE_REGEX.match(value)
+            if file_match is None:
+                raise ValueError('Unable to parse CUE FILE entry: {}'.format(line))
+            name = file_match.group('quoted') or file_match.group('bare')
+            current_file = CueFile(name, file_match.group('type'))
+            current_track = None
+            sheet.files.append(current_file)
+        elif command == 'TRACK':
+            if current_file is None:
+                raise ValueError('CUE TRACK entry precedes any FILE entry: {}'.format(line))
+            current_track = CueTrack(int(value.split()[0]))
+            current_file.tracks.append(current_track)
+        elif command == 'INDEX':
+            index_match = INDEX_REGEX.match(value)
+            if index_match is None or current_track is None:
+                raise ValueError('Unable to parse CUE INDEX entry: {}'.format(line))
+            if int(index_match.group('number')) == 1:
+                current_track.start = parse_timestamp(value.split()[1])
+        elif command in ('TITLE', 'PERFORMER', 'SONGWRITER'):
+            target = sheet if current_track is None else current_track
+            setattr(target, command.lower(), unquote(value))
+        elif command == 'ISRC' and current_track is not None:
+            current_track.isrc = unquote(value)
+        elif command == 'REM' and current_track is None:
+            words = value.split(None, 1)
+            if len(words) == 2:
+                sheet.rem[words[0].upper()] = unquote(words[1])
+
+    #Each track ends where the next track of the same file begins
+    for cue_file in sheet.files:
+        cue_file.tracks = [t for t in cue_file.tracks if t.start is not None]
+        for track, following in zip(cue_file.tracks, cue_file.tracks[1:]):
+            track.end = following.start
+    return sheet
+
+
+def read_cue(path):
+    """Read and parse a CUE sheet file, which may not be in UTF-8."""
+    with open(path, 'rb') as cue_file:
+        data = cue_file.read()
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        text = data.decode('cp1252', errors='replace')
+    return parse_cue(text)
+
+
+def find_images(dirpath, filenames, extensions):
+    """
+    Locate the album images described by the CUE sheets among `filenames` in
+    `dirpath`. Returns a mapping of image file name to a tuple of (CueSheet,
+    CueFile) for each image which holds more than one track, and the set of
+    CUE sheet file names that were used.
+
+    Only images with one of `extensions`, the audio that will be
+    transcoded, are matched, whether named exactly or not, so that a CUE
+    sheet is only left out when its image is split. CUE sheets often name the
+    image by the extension it had when ripped, so an image of the same stem
+    and any of `extensions` will be matched. Extensions are compared as is,
+    as they are by the transcodes.
+    """
+    images = {}
+    used = set()
+    by_stem = {}
+    for filename in filenames:
+        stem, ext = os.path.splitext(filename)
+        if ext in extensions:
+            by_stem.setdefault(stem, filename)
+
+    for filename in filenames:
+        if os.path.splitext(filename)[1].lower() != '.cue':
+            continue
+        try:
+            sheet = read_cue(os.path.join(dirpath, filename))
+        except (OSError, ValueError) as e:
+            print('Unable to read CUE sheet {}: {}'.format(filename, e))
+            continue
+        for cue_file in sheet.files:
+            if len(cue_file.tracks) < 2:
+                continue
+            name = os.path.basename(cue_file.name.replace('\\', '/'))
+            if name not in filenames or os.path.splitext(name)[1] not in extensions:
+                name = by_stem.get(os.path.splitext(name)[0])
+            if name is None or name in images:
+                continue
+            images[name] = (sheet, cue_file)
+            used.add(filename)
+    return images, used
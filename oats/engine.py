@@ -0,0 +1,563 @@
+"""
+Task execution engine for OATS
+
+Runs tasks on an asyncio event loop, with each command of a task a
+subprocess supervised by the loop rather than by a blocking thread. Tasks
+are pulled from their iterable only as slots free up, so any number may be
+queued. Subprocesses are started in their own process group so that a timed
+out or cancelled task can be killed along with any children it spawned. Tasks
+which only move data are limited per storage device (see DeviceScheduler).
+"""
+
+import asyncio
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+#Lines of a failed command's stderr to report
+STDERR_TAIL = 10
+#Kinds of task (see script.Task) which only move data, limited per device
+IO_KINDS = {'copy', 'remux'}
+#Tasks set aside waiting for their device, beyond which no more are pulled
+IO_LOOKAHEAD = 64
+
+
+class ThreadBudget(object):
+    """
+    Hands out thread counts to tasks as they start. While there are more
+    tasks outstanding than cores, each task gets a single thread. Once all
+    tasks have been queued, the cores are shared among those that remain so
+    that the tail of a run still uses the whole machine.
+    """
+    def __init__(self, cores):
+        self.cores = cores
+        self.outstanding = 0
+        self.exhausted = False
+        self.lock = threading.Lock()
+
+    def submit(self):
+        with self.lock:
+            self.outstanding += 1
+
+    def share(self):
+        with self.lock:
+            if not self.exhausted or self.outstanding >= self.cores:
+                return 1
+            return max(1, self.cores // self.outstanding)
+
+    def done(self):
+        with self.lock:
+            self.outstanding -= 1
+
+
+#I/O scheduling classes of the ionice tool
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+
+def parse_cpu_list(text):
+    """Parse a CPU list like "0-3,6" into a set of CPU numbers."""
+    cpus = set()
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, _sep, last = part.partition('-')
+        if not first.isdigit() or (last and not last.isdigit()):
+            raise ValueError('Invalid CPU list: {}'.format(text))
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+class ProcessLimits(object):
+    """
+    Resource controls applied to every subprocess the engine starts: a nice
+    value, an I/O scheduling class (and level) applied with the ionice tool,
+    a set of CPUs to pin the process to, and a limit in bytes on its address
+    space. These are applied in the child before the command is executed, so
+    anything the command starts inherits them too. They are POSIX only, and
+    CPU pinning is Linux only.
+    """
+    def __init__(self, nice=0, ioclass=None, iolevel=None, cpus=None, memory=None):
+        self.nice = nice
+        self.ioclass = ioclass
+        self.iolevel = iolevel
+        self.cpus = cpus
+        self.memory = memory
+        self.ionice = shutil.which('ionice') if ioclass is not None else None
+        if ioclass is not None and self.ionice is None:
+            print('ionice was not found, the I/O scheduling class will not be set')
+
+    def __bool__(self):
+        return bool(self.nice or self.ionice or self.cpus or self.memory)
+
+    def wrap(self, command):
+        """Prefix a command with ionice, if an I/O scheduling class is set."""
+        if self.ionice is None:
+            return command
+        prefix = [self.ionice, '-c', str(IONICE_CLASSES[self.ioclass])]
+        if self.iolevel is not None:
+            prefix += ['-n', str(self.iolevel)]
+        return prefix + ['--'] + list(command)
+
+    def preexec(self):
+        """Apply the limits to the current process, run in the child before exec."""
+        if self.nice:
+            os.nice(self.nice)
+        if self.cpus:
+            os.sched_setaffinity(0, self.cpus)
+        if self.memory:
+            resource.setrlimit(resource.RLIMIT_AS, (self.memory, self.memory))
+
+
+def device_of(path):
+    """
+    The st_dev of the device holding a path, or of its nearest existing
+    parent, as for an output not yet written.
+    """
+    while True:
+        try:
+            return os.stat(path).st_dev
+        except FileNotFoundError:
+            parent = os.path.dirname(path)
+            if parent == path:
+                raise
+            path = parent
+
+
+def rotational(device):
+    """
+    Whether a device is a spinning disk, from Linux sysfs. Partitions take
+    the queue of their disk. False where it cannot be told, as for network
+    filesystems.
+    """
+    if not hasattr(os, 'major'):
+        return False
+    base = '/sys/dev/block/{}:{}'.format(os.major(device), os.minor(device))
+    for path in [os.path.join(base, 'queue', 'rotational'),
+                 os.path.join(base, '..', 'queue', 'rotational')]:
+        try:
+            with open(path, 'r') as flag:
+                return flag.read().strip() == '1'
+        except OSError:
+            continue
+    return False
+
+
+class DeviceScheduler(object):
+    """
+    Limits the I/O heavy work on each device, such as hashing and copying
+    files, to `per_device` pieces of work at once, so that a spinning disk
+    streams one file after another rather than seeking between many. Devices
+    are told apart by the st_dev of their files, and work on different
+    devices goes on in parallel. If `per_device` is None, spinning disks are
+    limited to one piece of work and other devices are not limited.
+
+    Work on the files of some paths holds all of their devices. Threads may
+    wait for them with `hold`. The engine instead uses `acquire` without
+    blocking, and runs other tasks meanwhile, being told of any `release`
+    by the listeners it adds.
+    """
+    def __init__(self, per_device=None):
+        self.per_device = per_device
+        self.limits = {}  # device -> limit, or None if unlimited
+        self.busy = {}    # device -> work in progress
+        self.listeners = []
+        self.condition = threading.Condition()
+
+    def limit(self, device):
+        if device not in self.limits:
+            if self.per_device is not None:
+                self.limits[device] = self.per_device
+            else:
+                self.limits[device] = 1 if rotational(device) else None
+        return self.limits[device]
+
+    def devices(self, *paths):
+        """The limited devices of the files of the paths"""
+        devices = set()
+        for path in paths:
+            if path is not None:
+                device = device_of(path)
+                with self.condition:
+                    if self.limit(device) is not None:
+                        devices.add(device)
+        return frozenset(devices)
+
+    def acquire(self, devices, blocking=True):
+        """Take a place on every one of the devices, returning whether it was taken"""
+        with self.condition:
+            while any(self.busy.get(device, 0) >= self.limits[device] for device in devices):
+                if not blocking:
+                    return False
+                self.condition.wait()
+            for device in devices:
+                self.busy[device] = self.busy.get(device, 0) + 1
+        return True
+
+    def release(self, devices):
+        with self.condition:
+            for device in devices:
+                self.busy[device] -= 1
+            self.condition.notify_all()
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener()
+
+    @contextmanager
+    def hold(self, *paths):
+        """Wait for a place on the devices of the paths, for the work of the block"""
+        devices = self.devices(*paths)
+        self.acquire(devices)
+        try:
+            yield
+        finally:
+            self.release(devices)
+
+
+def read_cpu_times():
+    """
+    Return the total and iowait CPU time of the system from /proc/stat, or
+    None where it is not available.
+    """
+    try:
+        with open('/proc/stat', 'r') as stat:
+            fields = stat.readline().split()
+    except OSError:
+        return None
+    if not fields or fields[0] != 'cpu' or len(fields) < 6:
+        return None
+    times = [int(f) for f in fields[1:]]
+    return sum(times), times[4]
+
+
+class ConcurrencyController(object):
+    """
+    Chooses the number of tasks in flight by hill climbing on the measured
+    throughput, the seconds of audio transcoded per second of wall time.
+    Every `interval` seconds the throughput of the last interval is compared
+    with that of the interval before. The level keeps moving in the same
+    direction while throughput improves, and turns back once it falls. While
+    the system spends more than IOWAIT_HIGH of its CPU time waiting on I/O,
+    as when sources are on a slow network share, the level is lowered.
+    Adjustment stops once all tasks have been queued, as the throughput of
+    the tail of a run says nothing about the level.
+    """
+    IOWAIT_HIGH = 0.25
+    TOLERANCE = 0.05
+
+    def __init__(self, initial, maximum, interval=15.0):
+        self.level = initial
+        self.maximum = maximum
+        self.interval = interval
+        self.direction = 1
+        self.previous = None
+        self.best = None  # (throughput, level)
+        self.work = 0.0
+        self.start = time.monotonic()
+        self.cpu_times = read_cpu_times()
+
+    def record(self, task):
+        self.work += getattr(task, 'work', 0.0) or 0.0
+
+    def update(self, exhausted=False):
+        now = time.monotonic()
+        elapsed = now - self.start
+        if elapsed < self.interval:
+            return
+        throughput = self.work / elapsed
+        cpu_times = read_cpu_times()
+        iowait = None
+        if cpu_times is not None and self.cpu_times is not None and cpu_times[0] > self.cpu_times[0]:
+            iowait = (cpu_times[1] - self.cpu_times[1]) / (cpu_times[0] - self.cpu_times[0])
+        self.work = 0.0
+        self.start = now
+        self.cpu_times = cpu_times
+        if exhausted:
+            return
+
+        if self.best is None or throughput > self.best[0]:
+            self.best = (throughput, self.level)
+        if iowait is not None and iowait > self.IOWAIT_HIGH:
+            self.direction = -1
+        elif self.previous is not None and throughput < self.previous * (1 - self.TOLERANCE):
+            self.direction = -self.direction
+        self.previous = throughput
+        level = min(self.maximum, max(1, self.level + self.direction))
+        if level == self.level:  # At a bound, so probe back the other way
+            self.direction = -self.direction
+        self.level = level
+        print('Concurrency: {:.1f}x realtime{}{}, now running {} tasks'.format(
+            throughput,
+            '' if iowait is None else ', {:.0%} iowait'.format(iowait),
+            ', load {:.1f}'.format(os.getloadavg()[0]) if hasattr(os, 'getloadavg') else '',
+            self.level))
+
+    def report(self):
+        if self.best is not None:
+            print('Concurrency: best throughput {:.1f}x realtime with {} tasks'.format(*self.best))
+
+
+def kill_process_group(proc):
+    """Kill a subprocess started by the engine, and its process group."""
+    try:
+        if os.name == 'posix':
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def remove_partials(task):
+    """Remove the files a task may have left half written."""
+    for path in task.partials:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class Engine(object):
+    """
+    Runs tasks with at most `processes` in flight. A task's commands are
+    run in order, each either a list of arguments run as a subprocess or a
+    callable run in a worker thread (see script.Task). Each task may take
+    at most `timeout` seconds, if given, before it is killed and failed.
+    Subprocesses are started under the ProcessLimits `limits`, if given. If
+    a ConcurrencyController is given, it decides the number of tasks in
+    flight instead of `processes`, which is still the number of cores shared
+    among the tasks. Tasks are reported to `metrics`, if given, as they start
+    and finish (see metrics.Metrics).
+
+    If a DeviceScheduler is given, tasks of the IO_KINDS are only started
+    once there is a place on the devices of their source and output. Until
+    then they are set aside, and the tasks after them, such as encodes, are
+    run instead.
+    """
+    def __init__(self, processes=None, timeout=None, limits=None, controller=None, metrics=None,
+                 devices=None):
+        self.processes = processes or os.cpu_count() or 1
+        self.timeout = timeout
+        self.limits = limits
+        self.controller = controller
+        self.metrics = metrics
+        self.devices = devices
+        self.held = {}  # task -> devices it holds
+        self.budget = ThreadBudget(self.processes)
+
+    def limit(self):
+        """The number of tasks to have in flight"""
+        if self.controller is not None:
+            return self.controller.level
+        return self.processes
+
+    def admit(self, task):
+        """Take the places on its devices a task needs, returning whether it may start"""
+        if self.devices is None or task.kind not in IO_KINDS:
+            return True
+        try:
+            devices = self.devices.devices(task.source, task.output)
+        except OSError:  # The task is left to fail on its own
+            return True
+        if not self.devices.acquire(devices, blocking=False):
+            return False
+        self.held[task] = devices
+        return True
+
+    def admitted(self, deferred):
+        """Take the first task set aside whose devices now have a place, if any"""
+        for i, task in enumerate(deferred):
+            if self.admit(task):
+                return deferred.pop(i)
+        return None
+
+    def release(self, task):
+        devices = self.held.pop(task, None)
+        if devices is not None:
+            self.devices.release(devices)
+
+    async def run(self, tasks):
+        """
+        Run the tasks and any follow-up tasks released as they finish. This
+        is an async iterator yielding each task as it is done, with its
+        `failed` and `elapsed` attributes set.
+
+        `tasks` may be an iterable, or an async iterable from which tasks are
+        awaited as they become available, so that work may be added while the
+        engine runs. Once the source has ended, or still has no task ready
+        when a running one finishes, the cores are shared among those still
+        running.
+        """
+        asynchronous = hasattr(tasks, '__aiter__')
+        iterator = tasks.__aiter__() if asynchronous else iter(tasks)
+        followups = []
+        deferred = []  # Tasks waiting for a place on their devices
+        running = set()
+        pulling = None  # The awaited next task of an async iterable
+        released = asyncio.Event()  # Set as any work leaves a device
+        waking = None  # The awaited release, while tasks are set aside
+        exhausted = False
+        if self.devices is not None:
+            listener = partial(asyncio.get_running_loop().call_soon_threadsafe, released.set)
+            self.devices.listeners.append(listener)
+        try:
+            while True:
+                released.clear()
+                while len(running) < self.limit():
+                    task = self.admitted(deferred)
+                    if task is None:
+                        if followups:
+                            task = followups.pop(0)
+                        elif exhausted or len(deferred) >= IO_LOOKAHEAD:
+                            break
+                        elif asynchronous:
+                            if pulling is None:
+                                pulling = asyncio.ensure_future(iterator.__anext__())
+                            if not pulling.done():
+                                break
+                            try:
+                                task = pulling.result()
+                            except StopAsyncIteration:
+                                exhausted = self.budget.exhausted = True
+                                continue
+                            finally:
+                                pulling = None
+                            self.budget.exhausted = False
+                            self.budget.submit()
+                        else:
+                            try:
+                                task = next(iterator)
+                            except StopIteration:
+                                exhausted = self.budget.exhausted = True
+                                continue
+                            self.budget.submit()
+                        if not self.admit(task):
+                            deferred.append(task)
+                            continue
+                    running.add(asyncio.ensure_future(self.execute(task)))
+                waiting = set(running)
+                if pulling is not None and not pulling.done():
+                    waiting.add(pulling)
+                if deferred:
+                    if waking is None:
+                        waking = asyncio.ensure_future(released.wait())
+                    waiting.add(waking)
+                if not waiting:
+                    break
+                finished, _pending = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+                if pulling is not None and not pulling.done():
+                    #The source has had nothing ready for as long as a task
+                    #took to finish, so share the cores as if it were drained
+                    self.budget.exhausted = True
+                for future in finished:
+                    if future is pulling:
+                        continue
+                    if future is waking:
+                        waking = None
+                        continue
+                    running.remove(future)
+                    task = future.result()
+                    self.release(task)
+                    if self.controller is not None:
+                        self.controller.record(task)
+                        self.controller.update(self.budget.exhausted)
+                    for followup in task.finish():
+                        self.budget.submit()
+                        followups.append(followup)
+                    self.budget.done()
+                    yield task
+        finally:
+            if pulling is not None:
+                pulling.cancel()
+            if waking is not None:
+                waking.cancel()
+            for future in running:
+                future.cancel()
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+            if self.devices is not None:
+                self.devices.listeners.remove(listener)
+                for task in list(self.held):
+                    self.release(task)
+
+    async def execute(self, task):
+        start = time.monotonic()
+        if self.metrics is not None:
+            self.metrics.started(task)
+        try:
+            if self.timeout:
+                await asyncio.wait_for(self.run_task(task), self.timeout)
+            else:
+                await self.run_task(task)
+        except asyncio.TimeoutError:
+            task.failed = True
+            print('Timed out after {} seconds: {!r}'.format(self.timeout, task))
+            remove_partials(task)
+        except asyncio.CancelledError:
+            task.failed = True
+            remove_partials(task)
+            raise
+        task.elapsed = time.monotonic() - start
+        if self.metrics is not None:
+            self.metrics.finished(task)
+        return task
+
+    async def run_task(self, task):
+        loop = asyncio.get_running_loop()
+        for command in task.iter_commands():
+            if callable(command):
+                try:
+                    command = await loop.run_in_executor(None, partial(command, threads=self.budget.share()))
+                except Exception as e:
+                    task.failed = True
+                    print('{!r} reports an error: {}'.format(command, e))
+                    continue
+                if command is None:  # The command was carried out in-process
+                    continue
+            if not await self.run_command(command):
+                task.failed = True
+        if task.failed:
+            remove_partials(task)
+
+    async def run_command(self, command):
+        """
+        Run a command as a subprocess in its own process group, returning
+        True if it succeeded. Its stderr is only reported if it fails.
+        """
+        if os.name == 'posix':
+            group = {'start_new_session': True}
+        else:
+            group = {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+        if self.limits:
+            group['preexec_fn'] = self.limits.preexec
+            command = self.limits.wrap(command)
+        try:
+            proc = await asyncio.create_subprocess_exec(*command,
+                                                        stdin=subprocess.DEVNULL,
+                                                        stdout=subprocess.DEVNULL,
+                                                        stderr=subprocess.PIPE,
+                                                        **group)
+        except (OSError, subprocess.SubprocessError) as e:
+            print('{} could not be run: {}'.format(' '.join(command), e))
+            return False
+        try:
+            _stdout, stderr = await proc.communicate()
+        except asyncio.CancelledError:
+            kill_process_group(proc)
+            await proc.wait()
+            raise
+        if proc.returncode != 0:
+            print('{} reports an error: code {}'.format(' '.join(command), proc.returncode))
+            for line in stderr.decode('utf-8', errors='replace').splitlines()[-STDERR_TAIL:]:
+                print('    {}'.format(line))
+            return False
+        return True
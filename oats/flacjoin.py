@@ -0,0 +1,258 @@
+"""
+Lossless joining of FLAC files encoded from consecutive segments of a source
+
+FLAC frames are coded independently, but each frame header carries its frame
+(or first sample) number and the STREAMINFO block describes the whole stream:
+its length, its frame and block sizes and the MD5 of its audio. Frames copied
+from separately encoded files as they are would restart their numbering at
+every join and keep the first file's STREAMINFO. Here the frames are copied
+with their headers renumbered, as a variable blocksize stream (segments end
+in a short frame), and STREAMINFO is written for the joined stream. The
+frame data itself is never decoded or altered.
+"""
+
+import os
+
+from .preflight import crc8, crc16
+
+#Metadata block types
+STREAMINFO = 0
+SEEKTABLE = 3
+
+#Block sizes in samples by the code of the frame header, where they are implied
+BLOCK_SIZES = {1: 192, 2: 576, 3: 1152, 4: 2304, 5: 4608,
+               8: 256, 9: 512, 10: 1024, 11: 2048, 12: 4096, 13: 8192, 14: 16384, 15: 32768}
+
+#The CRC-16 polynomial of FLAC frames, x^16 + x^15 + x^2 + 1
+CRC16_POLYNOMIAL = 0x18005
+
+
+def _mulmod(a, b):
+    """Multiply two polynomials over GF(2), modulo the CRC-16 polynomial"""
+    product = 0
+    while b:
+        if b & 1:
+            product ^= a
+        b >>= 1
+        a <<= 1
+        if a & 0x10000:
+            a ^= CRC16_POLYNOMIAL
+    return product
+
+
+def crc16_extend(crc, length):
+    """
+    Return the CRC-16 of data whose CRC-16 is `crc` once followed by
+    `length` zero bytes, without reading them. As the CRC is linear, the
+    CRC of a frame whose header changes is found from its old CRC this way,
+    rather than over all of its data again.
+    """
+    factor, power, exponent = 1, 2, 8 * length  # x^0, x^1
+    while exponent:
+        if exponent & 1:
+            factor = _mulmod(factor, power)
+        power = _mulmod(power, power)
+        exponent >>= 1
+    return _mulmod(crc, factor)
+
+
+def coded_number(number):
+    """Code a frame or sample number in the UTF-8 style of frame headers"""
+    if number < 0x80:
+        return bytes([number])
+    length = 2
+    while number >= 1 << (5 * length + 1):
+        length += 1
+    tail = []
+    for _ in range(length - 1):
+        tail.append(0x80 | (number & 0x3F))
+        number >>= 6
+    return bytes([((0xFF00 >> length) & 0xFF) | number] + tail[::-1])
+
+
+def parse_frame_header(data, offset):
+    """
+    Parse the frame header at `offset` of `data`, returning its length
+    (including the CRC-8), whether it is of a variable blocksize stream, its
+    coded frame or sample number and its block size in samples. Return None
+    if there is no valid frame header there.
+    """
+    if offset + 6 > len(data) or data[offset] != 0xFF or data[offset + 1] & 0xFE != 0xF8:
+        return None
+    variable = data[offset + 1] & 0x01
+    blocksize_code = data[offset + 2] >> 4
+    rate_code = data[offset + 2] & 0x0F
+    if blocksize_code == 0 or rate_code == 0x0F:
+        return None
+    pos = offset + 4
+    lead = data[pos]
+    if lead < 0x80:
+        length, number = 1, lead
+    elif lead == 0xFF or 0x80 <= lead < 0xC0:
+        return None
+    else:
+        length = 1
+        while lead & (0x80 >> length):
+            length += 1
+        number = lead & (0x7F >> length)
+    if pos + length > len(data):
+        return None
+    for byte in data[pos + 1:pos + length]:
+        if byte & 0xC0 != 0x80:
+            return None
+        number = (number << 6) | (byte & 0x3F)
+    pos += length
+    if blocksize_code in (6, 7):
+        size = blocksize_code - 5
+        blocksize = int.from_bytes(data[pos:pos + size], 'big') + 1
+        pos += size
+    else:
+        blocksize = BLOCK_SIZES[blocksize_code]
+    if rate_code in (12, 13, 14):
+        pos += 1 if rate_code == 12 else 2
+    if pos >= len(data) or crc8(data[offset:pos]) != data[pos]:
+        return None
+    return pos + 1 - offset, variable, number, blocksize
+
+
+def read_metadata(data):
+    """
+    Return the metadata blocks at the start of FLAC file data, as a list of
+    (block type, block data), and the offset of the first frame.
+    """
+    if data[:4] != b'fLaC':
+        raise ValueError('missing fLaC stream marker')
+    blocks = []
+    pos = 4
+    while True:
+        if pos + 4 > len(data):
+            raise ValueError('metadata blocks are truncated')
+        header = data[pos:pos + 4]
+        length = int.from_bytes(header[1:4], 'big')
+        blocks.append((header[0] & 0x7F, data[pos + 4:pos + 4 + length]))
+        pos += 4 + length
+        if header[0] & 0x80:
+            break
+    if not blocks or blocks[0][0] != STREAMINFO or len(blocks[0][1]) < 34:
+        raise ValueError('missing STREAMINFO block')
+    return blocks, pos
+
+
+def iter_frames(data, offset):
+    """
+    Yield the frames of FLAC file data from the offset of its first frame,
+    as (header length, block size, frame). A frame ends where the header of
+    the next frame in sequence begins, the CRC-8, number and stream
+    properties of which rule out a sync code occurring by chance within
+    frame data.
+    """
+    header = parse_frame_header(data, offset)
+    if header is None:
+        raise ValueError('no valid frame header at offset {}'.format(offset))
+    sync = data[offset:offset + 2]
+    #The channel assignment may change from frame to frame, the sample size not
+    sample_size = data[offset + 3] & 0x0F
+    number = header[2]
+    while header is not None:
+        length, variable, _number, blocksize = header
+        number += blocksize if variable else 1
+        following = None
+        search = offset + length
+        while True:
+            search = data.find(sync, search)
+            if search < 0:
+                break
+            following = parse_frame_header(data, search)
+            if following is not None and following[2] == number and data[search + 3] & 0x0F == sample_size:
+                break
+            following = None
+            search += 1
+        end = len(data) if following is None else search
+        yield length, blocksize, data[offset:end]
+        offset, header = end, following
+
+
+def renumbered(frame, length, sample):
+    """
+    Return a frame with its header rewritten for a variable blocksize stream,
+    numbered by its first sample, and its CRC-16 updated to match.
+    """
+    header = frame[:length - 1]
+    lead = header[4]
+    coded = 1 if lead < 0x80 else bin(lead)[2:].index('0')
+    new_header = bytes([0xFF, 0xF9]) + header[2:4] + coded_number(sample) + header[4 + coded:]
+    new_header += bytes([crc8(new_header)])
+    body = frame[length:-2]
+    #The CRC of the header and data is that of the header extended by the
+    #length of the data, combined with that of the data alone
+    old_crc = int.from_bytes(frame[-2:], 'big')
+    data_crc = old_crc ^ crc16_extend(crc16(frame[:length]), len(body))
+    crc = crc16_extend(crc16(new_header), len(body)) ^ data_crc
+    return new_header + body + crc.to_bytes(2, 'big')
+
+
+def join(parts, dest, threads=1):
+    """
+    Join FLAC files encoded from consecutive segments of a source into the
+    destination, in order. The metadata blocks of the first file are kept but
+    for its seek table, which would no longer match. The MD5 of the joined
+    audio is left unset, to be set by `set_md5` once it is decoded.
+    """
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    streaminfo, blocks = None, None
+    sample = 0
+    block_sizes, frame_sizes = [], set()
+    with open(dest, 'wb') as out:
+        for part in parts:
+            with open(part, 'rb') as f:
+                data = f.read()
+            part_blocks, first_frame = read_metadata(data)
+            if streaminfo is None:
+                streaminfo = part_blocks[0][1]
+                blocks = [block for block in part_blocks[1:] if block[0] != SEEKTABLE]
+                #The metadata is written once the sizes are known
+                out.write(bytes(4 + 4 + 34 + sum(4 + len(block) for _type, block in blocks)))
+            elif part_blocks[0][1][10:13] != streaminfo[10:13] or \
+                    (part_blocks[0][1][13] ^ streaminfo[13]) & 0xF0:
+                raise ValueError('{} differs in its sample rate, channels or bit depth'.format(part))
+            for length, blocksize, frame in iter_frames(data, first_frame):
+                frame = renumbered(frame, length, sample)
+                out.write(frame)
+                sample += blocksize
+                block_sizes.append(blocksize)
+                frame_sizes.add(len(frame))
+        #The last block may be shorter than the minimum block size
+        shortest = min(block_sizes[:-1] or block_sizes)
+        packed = int.from_bytes(streaminfo[10:18], 'big') & ~0xFFFFFFFFF | sample
+        info = (shortest.to_bytes(2, 'big') + max(block_sizes).to_bytes(2, 'big') +
+                min(frame_sizes).to_bytes(3, 'big') + max(frame_sizes).to_bytes(3, 'big') +
+                packed.to_bytes(8, 'big') + bytes(16))
+        out.seek(0)
+        out.write(b'fLaC')
+        blocks = [(STREAMINFO, info)] + blocks
+        for i, (block_type, block) in enumerate(blocks):
+            last = 0x80 if i == len(blocks) - 1 else 0
+            out.write(bytes([last | block_type]) + len(block).to_bytes(3, 'big') + block)
+
+
+def bit_depth(path):
+    """Return the bits per sample of a FLAC file, by its STREAMINFO"""
+    with open(path, 'rb') as f:
+        streaminfo = f.read(4 + 4 + 34)[8:]
+    return ((int.from_bytes(streaminfo[10:18], 'big') >> 36) & 0x1F) + 1
+
+
+def set_md5(path, md5file, threads=1):
+    """
+    Set the STREAMINFO MD5 of a FLAC file from the FFmpeg md5 muxer output
+    of its decoded audio, and remove that output.
+    """
+    with open(md5file) as f:
+        digest = bytes.fromhex(f.read().strip().partition('=')[2])
+    if len(digest) != 16:
+        raise ValueError('no MD5 in {}'.format(md5file))
+    with open(path, 'r+b') as f:
+        #STREAMINFO is always the first metadata block, after the stream marker
+        f.seek(4 + 4 + 18)
+        f.write(digest)
+    os.remove(md5file)
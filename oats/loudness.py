@@ -0,0 +1,296 @@
+"""
+Loudness measurement for OATS
+
+Measures the integrated loudness of audio following ITU-R BS.1770 / EBU R128
+and derives ReplayGain 2.0 values from it. Audio is read from the wav files
+decoded for transcoding, in blocks, so that no further decode is required.
+NumPy is required by this module.
+"""
+
+import math
+import struct
+import threading
+
+import numpy
+
+#ReplayGain 2.0 reference level, in LUFS
+REPLAYGAIN_REFERENCE = -18.0
+#EBU R128 reference level, in LUFS, used by the Opus R128_*_GAIN tags
+R128_REFERENCE = -23.0
+
+ABSOLUTE_GATE = -70.0  # LUFS
+RELATIVE_GATE = -10.0  # LU
+
+#Channel weights by channel count, for the default channel layouts. The LFE
+#channel of 5.1 is excluded and the surround channels weighted up.
+CHANNEL_WEIGHTS = {6: [1.0, 1.0, 1.0, 0.0, 1.41, 1.41]}
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+BLOCK_FRAMES = 2**16
+
+_impulse_cache = {}
+_impulse_lock = threading.Lock()
+
+
+def biquad_coefficients(rate):
+    """
+    Return the (b, a) coefficients of the two K-weighting filter stages, a
+    high shelf and a high pass, designed for the given sample rate.
+    """
+    f0 = 1681.974450955533
+    gain = 3.999843853973347
+    q = 0.7071752369554196
+    k = math.tan(math.pi * f0 / rate)
+    vh = 10 ** (gain / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = ([(vh + vb * k / q + k * k) / a0,
+              2 * (k * k - vh) / a0,
+              (vh - vb * k / q + k * k) / a0],
+             [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0])
+
+    f0 = 38.13547087602444
+    q = 0.5003270373238773
+    k = math.tan(math.pi * f0 / rate)
+    a0 = 1 + k / q + k * k
+    highpass = ([1.0, -2.0, 1.0],
+                [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0])
+    return shelf, highpass
+
+
+def kweighting_impulse(rate):
+    """
+    Return the impulse response of the K-weighting filter for the sample
+    rate, truncated after a quarter second where it has decayed far below
+    the precision of the measurement. Filtering then becomes an FFT
+    convolution, which NumPy can do without a per-sample loop.
+    """
+    with _impulse_lock:
+        if rate not in _impulse_cache:
+            length = int(rate * 0.25)
+            signal = [0.0] * length
+            signal[0] = 1.0
+            for b, a in biquad_coefficients(rate):
+                x1 = x2 = y1 = y2 = 0.0
+                output = []
+                for x in signal:
+                    y = b[0] * x + b[1] * x1 + b[2] * x2 - a[1] * y1 - a[2] * y2
+                    x2, x1 = x1, x
+                    y2, y1 = y1, y
+                    output.append(y)
+                signal = output
+            _impulse_cache[rate] = numpy.array(signal)
+        return _impulse_cache[rate]
+
+
+class LoudnessMeter(object):
+    """
+    Accumulates the gating block powers and sample peak of audio fed to it in
+    blocks of shape (frames, channels), scaled to [-1.0, 1.0].
+    """
+    def __init__(self, rate, channels):
+        self.rate = rate
+        self.channels = channels
+        self.weights = numpy.array(CHANNEL_WEIGHTS.get(channels, [1.0] * channels))
+        self.impulse = kweighting_impulse(rate)
+        self.tail = numpy.zeros((len(self.impulse) - 1, channels))
+        self.step = int(round(rate * 0.1))  # 100 ms, a quarter gating block
+        self.leftover = numpy.zeros((0, channels))
+        self.quarters = []  # Mean square per channel of each 100 ms step
+        self.peak = 0.0
+
+    def feed(self, samples):
+        if len(samples) == 0:
+            return
+        self.peak = max(self.peak, float(numpy.abs(samples).max()))
+        #Overlap-add convolution with the K-weighting impulse response
+        size = len(samples) + len(self.impulse) - 1
+        nfft = 1 << (size - 1).bit_length()
+        spectrum = numpy.fft.rfft(self.impulse, nfft)[:, None]
+        filtered = numpy.fft.irfft(numpy.fft.rfft(samples, nfft, axis=0) * spectrum, nfft, axis=0)[:size]
+        filtered[:len(self.tail)] += self.tail
+        self.tail = filtered[len(samples):]
+        filtered = filtered[:len(samples)]
+
+        squared = numpy.concatenate([self.leftover, filtered * filtered])
+        whole = len(squared) // self.step * self.step
+        if whole:
+            steps = squared[:whole].reshape(-1, self.step, self.channels).mean(axis=1)
+            self.quarters.extend(steps)
+        self.leftover = squared[whole:]
+
+    def blocks(self):
+        """
+        Return the channel weighted power of each 400 ms gating block, the
+        blocks overlapping by 75%.
+        """
+        if len(self.quarters) < 4:
+            return numpy.zeros(0)
+        quarters = numpy.array(self.quarters)
+        windows = (quarters[:-3] + quarters[1:-2] + quarters[2:-1] + quarters[3:]) / 4
+        return windows @ self.weights
+
+
+def block_loudness(power):
+    with numpy.errstate(divide='ignore'):
+        return -0.691 + 10 * numpy.log10(power)
+
+
+def integrated_loudness(blocks):
+    """
+    Return the gated integrated loudness in LUFS of the gating block powers,
+    or None if the audio is silent.
+    """
+    blocks = blocks[block_loudness(blocks) > ABSOLUTE_GATE]
+    if len(blocks) == 0:
+        return None
+    relative_gate = block_loudness(blocks.mean()) + RELATIVE_GATE
+    blocks = blocks[block_loudness(blocks) > relative_gate]
+    return float(block_loudness(blocks.mean()))
+
+
+def read_wav(path, block_frames=BLOCK_FRAMES):
+    """
+    Yield the sample rate and channel count of a wav file, followed by blocks
+    of its samples as float arrays of shape (frames, channels) in [-1.0, 1.0].
+    Integer PCM of 8 to 32 bits and float PCM are supported, in either the
+    plain or extensible wav formats.
+    """
+    with open(path, 'rb') as wav:
+        riff, _size, wave = struct.unpack('<4sI4s', wav.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise ValueError('Not a RIFF WAVE file: {}'.format(path))
+        fmt = None
+        while True:
+            header = wav.read(8)
+            if len(header) < 8:
+                raise ValueError('No data chunk in wav file: {}'.format(path))
+            chunk_id, chunk_size = struct.unpack('<4sI', header)
+            if chunk_id == b'fmt ':
+                fmt = wav.read(chunk_size + chunk_size % 2)
+            elif chunk_id == b'data':
+                break
+            else:
+                wav.seek(chunk_size + chunk_size % 2, 1)
+        if fmt is None:
+            raise ValueError('No fmt chunk in wav file: {}'.format(path))
+
+        tag, channels, rate, _byte_rate, align, bits = struct.unpack('<HHIIHH', fmt[:16])
+        if tag == WAVE_FORMAT_EXTENSIBLE:
+            tag = struct.unpack('<H', fmt[24:26])[0]
+        width = align // channels
+        if tag == WAVE_FORMAT_IEEE_FLOAT and width in (4, 8):
+            dtype, scale = '<f{}'.format(width), 1.0
+        elif tag == WAVE_FORMAT_PCM and width in (1, 2, 3, 4):
+            dtype, scale = None, float(2 ** (8 * width - 1))
+        else:
+            raise ValueError('Unsupported wav sample format {} ({} bytes) in {}'.format(tag, width, path))
+
+        yield rate, channels
+        #ffmpeg may leave the data size unset when writing to a pipe, so the
+        #data chunk is read until the end of the file
+        while True:
+            data = wav.read(block_frames * align)
+            data = data[:len(data) // align * align]
+            if not data:
+                break
+            if dtype is not None:
+                samples = numpy.frombuffer(data, dtype=dtype).astype(numpy.float64)
+            elif width == 1:  # 8 bit wav is unsigned
+                samples = numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.float64) - 128
+            elif width == 3:
+                raw = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, 3)
+                samples = (raw[:, 0].astype(numpy.int32)
+                           | (raw[:, 1].astype(numpy.int32) << 8)
+                           | (raw[:, 2].astype(numpy.int8).astype(numpy.int32) << 16)).astype(numpy.float64)
+            else:
+                samples = numpy.frombuffer(data, dtype='<i{}'.format(width)).astype(numpy.float64)
+            yield samples.reshape(-1, channels) / scale
+
+
+def measure_wav(path):
+    """Return the gating block powers and the sample peak of a wav file."""
+    reader = read_wav(path)
+    rate, channels = next(reader)
+    meter = LoudnessMeter(rate, channels)
+    for samples in reader:
+        meter.feed(samples)
+    return meter.blocks(), meter.peak
+
+
+class AlbumLoudness(object):
+    """
+    Collects the loudness measurements of the tracks of an album as their wav
+    files are decoded, and composes the ReplayGain values of each output once
+    every track has been measured. A track may be measured in several parts,
+    as when it is encoded in segments. Whichever format first measures a track
+    decides whether it is measured whole or in parts, so that when formats
+    differ no audio of it is counted twice.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.parts = {}     # track -> {part: (blocks, peak)}
+        self.claimed = set()
+        self.whole = {}     # track -> whether it is measured whole
+        self.outputs = []   # (track, output path)
+
+    def register(self, track, output):
+        self.outputs.append((track, output))
+
+    def measure(self, track, part, wavfile, threads=1):
+        """
+        Measure a decoded wav file, unless another format has already claimed
+        the same part of the track, or measures the track split differently.
+        A `part` of None is the whole track. Used as an in-process task command.
+        """
+        with self.lock:
+            if self.whole.setdefault(track, part is None) != (part is None) or (track, part) in self.claimed:
+                return None
+            self.claimed.add((track, part))
+        try:
+            result = measure_wav(wavfile)
+        except (OSError, ValueError) as e:
+            print('Unable to measure loudness of {}: {}'.format(wavfile, e))
+            return None
+        with self.lock:
+            self.parts.setdefault(track, {})[part] = result
+        return None
+
+    def track_result(self, track):
+        parts = self.parts.get(track)
+        if not parts:
+            return None
+        blocks = numpy.concatenate([blocks for blocks, _peak in parts.values()])
+        peak = max(peak for _blocks, peak in parts.values())
+        return blocks, peak
+
+    def gains(self):
+        """
+        Return a list of (output path, gains) where gains is a dictionary with
+        the keys 'track_loudness', 'track_peak', and if every track of the
+        album was measured, 'album_loudness' and 'album_peak'.
+        """
+        tracks = set(track for track, _output in self.outputs)
+        results = dict((track, self.track_result(track)) for track in tracks)
+        album = None
+        if tracks and all(results.values()):
+            album_blocks = numpy.concatenate([blocks for blocks, _peak in results.values()])
+            album = (integrated_loudness(album_blocks),
+                     max(peak for _blocks, peak in results.values()))
+
+        gains = []
+        for track, output in self.outputs:
+            if results[track] is None:
+                continue
+            blocks, peak = results[track]
+            loudness = integrated_loudness(blocks)
+            if loudness is None:
+                continue
+            values = {'track_loudness': loudness, 'track_peak': peak}
+            if album is not None and album[0] is not None:
+                values['album_loudness'], values['album_peak'] = album
+            gains.append((output, values))
+        return gains
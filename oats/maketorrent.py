@@ -1,12 +1,29 @@
 import os.path
 import os
 import hashlib
+import json
 import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from . import bencode
 
 from urllib.parse import urlparse
 
+#Automatic piece lengths are the shortest power of two giving at most
+#PIECE_TARGET pieces, within these bounds
+PIECE_TARGET = 1500
+MIN_PIECE_LENGTH = 2**15
+MAX_PIECE_LENGTH = 2**24
+#Bytes of pieces hashed by each job of a HashPool
+HASH_RUN = 2**22
+#The most space the piece hash cache may take, and the fraction of it used
+#once the least recently used entries are evicted
+PIECE_CACHE_CAPACITY = 2**26
+PIECE_CACHE_EVICT_TO = 0.9
+
 
 def validPath(path):
     """argparse path helper."""
@@ -102,25 +119,358 @@ class fileListConcatenator(object):
             return True
 
 
-def makePieces(files, psize):
-    """Concatenate file piece hashes"""
-    pieces = b''
+class PieceCache(object):
+    """
+    An on-disk cache of the piece hashes of file lists. The piece hashes only
+    depend upon the contents and order of the files and the piece length, so
+    torrents of the same files differing only in announce URL, source or
+    private flag can reuse them. Entries are keyed by the path, size, mtime
+    and inode of every file along with the piece length, so any change to the
+    files invalidates their entry. Each use of an entry updates its
+    modification time, by which the least recently used, as of files since
+    changed or removed, are evicted once the cache holds more than
+    `capacity` bytes. Entries are written atomically, so a cache may be
+    shared by several threads or processes.
+    """
+
+    def __init__(self, directory, capacity=PIECE_CACHE_CAPACITY):
+        self.directory = directory
+        self.capacity = capacity
+        self.size = None  # Bytes held, found on first put
+        self.lock = threading.Lock()
+
+    def key(self, files, psize):
+        """Compose the cache key of a file list, or None if a file is missing"""
+        stats = []
+        for filepath in files:
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                return None
+            stats.append([os.path.abspath(filepath), st.st_size, st.st_mtime_ns, st.st_dev, st.st_ino])
+        description = json.dumps([psize, stats]).encode()
+        return hashlib.sha1(description).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.pieces')
+
+    def get(self, key, length):
+        """Return the cached piece hashes of a key, checked against the total length"""
+        try:
+            with open(self.path(key), 'rb') as entry:
+                pieces = entry.read()
+            os.utime(self.path(key))
+        except OSError:
+            return None
+        if len(pieces) != 20 * length:
+            return None
+        return pieces
+
+    def put(self, key, pieces):
+        directory = os.path.dirname(self.path(key))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, temppath = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as entry:
+                entry.write(pieces)
+            os.replace(temppath, self.path(key))
+        except OSError as e:
+            print('Unable to write piece hash cache entry: {}'.format(e))
+            return
+        self.grow(len(pieces))
+
+    def entries(self):
+        """List the (mtime, size, path) of every entry in the cache"""
+        entries = []
+        for dirpath, _dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith('.pieces'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:  # Evicted meanwhile by another process
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def grow(self, size):
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for _mtime, size, _path in self.entries())
+            else:
+                self.size += size
+            if self.size > self.capacity:
+                self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is below capacity"""
+        entries = sorted(self.entries())
+        self.size = sum(size for _mtime, size, _path in entries)
+        for _mtime, size, path in entries:
+            if self.size <= self.capacity * PIECE_CACHE_EVICT_TO:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+
+
+class HashStats(object):
+    """The bytes hashed, and the seconds spent hashing them, by all threads"""
+
+    def __init__(self):
+        self.bytes = 0
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, length, seconds):
+        with self.lock:
+            self.bytes += length
+            self.seconds += seconds
+
+    def totals(self):
+        with self.lock:
+            return self.bytes, self.seconds
+
+
+hash_stats = HashStats()
+
+
+def pieceLength(total):
+    """
+    The piece length of a torrent of `total` bytes: the shortest power of two
+    giving no more than PIECE_TARGET pieces, between MIN_PIECE_LENGTH and
+    MAX_PIECE_LENGTH. Torrents so have few enough piece hashes to load
+    quickly however large they are, and small ones are not one or two pieces.
+    """
+    psize = MIN_PIECE_LENGTH
+    while psize < MAX_PIECE_LENGTH and psize * PIECE_TARGET < total:
+        psize *= 2
+    return psize
+
+
+def hashRun(block, psize):
+    """Hash the pieces of a block, as a job of a HashPool"""
+    start = time.monotonic()
+    view = memoryview(block)
+    pieces = b''.join(hashlib.sha1(view[i:i + psize]).digest() for i in range(0, len(block), psize))
+    hash_stats.add(len(block), time.monotonic() - start)
+    return pieces
+
+
+class HashPool(object):
+    """
+    A pool of threads hashing the pieces of the torrents of a batch. Each
+    torrent is read in sequence by the thread making it, and its pieces are
+    hashed by the pool in runs of HASH_RUN bytes, so that a large torrent is
+    hashed on every core while small torrents share them. At most twice as
+    many runs as threads are read ahead, across all torrents. The bytes
+    hashed and the time spent hashing any torrent are totalled for the
+    whole batch (see report). A pool of one thread hashes in the thread
+    reading instead.
+    """
+
+    def __init__(self, threads=None):
+        threads = threads or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(threads) if threads > 1 else None
+        self.slots = threading.BoundedSemaphore(2 * threads)
+        self.lock = threading.Lock()
+        self.torrents = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.active = 0
+        self.since = None  # When the current spell of hashing began
+
+    def hash(self, files, psize):
+        """Hash the pieces of the concatenated files, read by the calling thread"""
+        runs = []
+        length = 0
+        with self.lock:
+            if self.active == 0:
+                self.since = time.monotonic()
+            self.active += 1
+        try:
+            with fileListConcatenator(files, psize * max(1, HASH_RUN // psize)) as f:
+                for block in f:
+                    length += len(block)
+                    if self.executor is None:
+                        runs.append(hashRun(block, psize))
+                        continue
+                    self.slots.acquire()
+                    run = self.executor.submit(hashRun, block, psize)
+                    run.add_done_callback(lambda run: self.slots.release())
+                    runs.append(run)
+            pieces = b''.join(run if self.executor is None else run.result() for run in runs)
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.bytes += length
+                self.torrents += 1
+                if self.active == 0:
+                    self.seconds += time.monotonic() - self.since
+        return pieces
+
+    def report(self):
+        """Describe the hashing of the batch, if any torrent was hashed"""
+        with self.lock:
+            if self.torrents == 0:
+                return None
+            seconds = self.seconds + (time.monotonic() - self.since if self.active else 0.0)
+            return 'Hashed {} torrents, {:.1f} MiB in {:.1f} s: {:.1f} MiB/s'.format(
+                self.torrents, self.bytes / 2**20, seconds, self.bytes / 2**20 / seconds if seconds > 0 else 0.0)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+def hashPieces(files, psize, pool=None):
+    """Hash the pieces of the concatenated files, by a HashPool if given"""
+    if pool is not None:
+        return pool.hash(files, psize)
+    pieces = []
+    length = 0
+    start = time.monotonic()
 
     with fileListConcatenator(files, psize) as f:
         for piece in f:
-            pieces += hashlib.sha1(piece).digest()
-
+            length += len(piece)
+            pieces.append(hashlib.sha1(piece).digest())
+
+    hash_stats.add(length, time.monotonic() - start)
+    return b''.join(pieces)
+
+
+def makePieces(files, psize, cache=None, pool=None):
+    """Concatenate file piece hashes, using and filling the cache if given"""
+    files = list(files)
+    if cache is None:
+        return hashPieces(files, psize, pool)
+
+    key = cache.key(files, psize)
+    if key is None:
+        return hashPieces(files, psize, pool)
+    total = sum(os.path.getsize(filepath) for filepath in files)
+    count = (total + psize - 1) // psize
+    pieces = cache.get(key, count)
+    if pieces is not None:
+        return pieces
+
+    pieces = hashPieces(files, psize, pool)
+    #Files changed while they were hashed must not be cached under the old key
+    if cache.key(files, psize) == key:
+        cache.put(key, pieces)
     return pieces
 
 
-def mktorrent(path, outfile, tracker=None, piecesize=2**18, private=True, magnet=False, source=None):
-    """Main function, writes metainfo file, fixed piece size for now"""
+class PieceHasher(object):
+    """
+    Hashes the pieces of files fed to it one after the other, carrying the
+    partial piece at the end of each file over to the next. Files may so be
+    hashed as soon as each is written, while still in the page cache, rather
+    than all read back once they are done. The files must be fed in the
+    order they will have in the torrent (see torrentOrder).
+    """
+
+    def __init__(self, psize=2**18):
+        self.psize = psize
+        self.hashes = []
+        self.partial = b''
+        self.files = []  # (path, size, mtime) of each file hashed
+        self.broken = False
+
+    def add(self, filepath):
+        """Hash a file, continuing from the end of the previous file"""
+        length = 0
+        start = time.monotonic()
+        with open(filepath, 'rb') as f:
+            while True:
+                block = f.read(self.psize - len(self.partial))
+                if not block:
+                    break
+                length += len(block)
+                if self.partial:
+                    block = self.partial + block
+                if len(block) == self.psize:
+                    self.hashes.append(hashlib.sha1(block).digest())
+                    self.partial = b''
+                else:
+                    self.partial = block
+            st = os.fstat(f.fileno())
+        hash_stats.add(length, time.monotonic() - start)
+        if st.st_size != length:  # Changed while it was read
+            self.broken = True
+        self.files.append((os.path.abspath(filepath), st.st_size, st.st_mtime_ns))
+
+    def pieces(self, files, psize):
+        """
+        Return the piece hashes if exactly the given files, unchanged since
+        they were hashed, were fed in the same order with the same piece
+        length, otherwise None.
+        """
+        if self.broken or psize != self.psize or len(files) != len(self.files):
+            return None
+        for filepath, (hashed, size, mtime) in zip(files, self.files):
+            if os.path.abspath(filepath) != hashed:
+                return None
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                return None
+            if (st.st_size, st.st_mtime_ns) != (size, mtime):
+                return None
+        pieces = b''.join(self.hashes)
+        if self.partial:
+            pieces += hashlib.sha1(self.partial).digest()
+        return pieces
+
+
+def torrentOrder(relpath):
+    """
+    Sort key of a path relative to the torrent's root, giving the order of
+    fileList: the files of a directory by name, then its subdirectories.
+    """
+    components = os.path.normpath(relpath).split(os.sep)
+    return [(1, d) for d in components[:-1]] + [(0, components[-1])]
+
+
+def fileList(root):
+    """
+    List the files beneath a directory in a stable order, as pairs of the file
+    path and its path components relative to `root`.
+    """
+    filelist = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            filepath = os.path.join(dirpath, filename)
+            filelist.append((filepath, os.path.relpath(filepath, root).split(os.sep)))
+    return filelist
+
+
+def buildTorrent(path, tracker=None, piecesize=None, private=True, source=None, cache=None, hasher=None,
+                 pool=None):
+    """
+    Compose the metainfo dictionary of a file or directory. File paths within
+    the torrent are made relative to `path` itself, so this does not depend
+    on the working directory and may be called from several threads at once.
+    `tracker` may be a single announce URL or a list of them. The piece
+    length is chosen by the size of the torrent (see pieceLength) unless
+    `piecesize` is given. Piece hashes are looked up in and added to
+    `cache`, a PieceCache, if given. They are taken from `hasher`, a
+    PieceHasher, if it hashed exactly these files with the piece length
+    the torrent would have anyway, and are otherwise hashed by `pool`, a
+    HashPool, if given.
+    """
+    if isinstance(tracker, str):
+        tracker = [tracker]
 
     # Common dict items
     torrent = {}
     torrent['info'] = {}
-    torrent['info']['piece length'] = piecesize
-    torrent['info']['name'] = os.path.basename(path.rstrip(os.sep))
+    torrent['info']['name'] = os.path.basename(os.path.abspath(path))
 
     if tracker:
         torrent['announce'] = tracker[0]
@@ -138,25 +488,49 @@ def mktorrent(path, outfile, tracker=None, piecesize=2**18, private=True, magnet
     if os.path.isfile(path):
 
         torrent['info']['length'] = os.path.getsize(path)
-        torrent['info']['pieces'] = makePieces([path], piecesize)
+        piecesize = piecesize or pieceLength(torrent['info']['length'])
+        torrent['info']['piece length'] = piecesize
+        torrent['info']['pieces'] = makePieces([path], piecesize, cache, pool)
 
     # Multiple file case
     elif os.path.isdir(path):
 
-        torrent['info']['files'] = []
+        filelist = fileList(path)
+        if not filelist:
+            raise ValueError('No files to make a torrent of in {}'.format(path))
+
+        torrent['info']['files'] = [{'length': os.path.getsize(filepath),
+                                     'path': components}
+                                    for filepath, components in filelist]
+        filepaths = [filepath for filepath, _ in filelist]
+        total = sum(entry['length'] for entry in torrent['info']['files'])
+        pieces = None
+        #Pieces hashed early are only used at the very piece length chosen
+        #otherwise, so that the torrent is the same as one made afterwards
+        if hasher is not None and hasher.psize == (piecesize or pieceLength(total)):
+            pieces = hasher.pieces(filepaths, hasher.psize)
+        if pieces is None:
+            piecesize = piecesize or pieceLength(total)
+            pieces = makePieces(filepaths, piecesize, cache, pool)
+        else:
+            piecesize = hasher.psize
+            if cache is not None:
+                key = cache.key(filepaths, piecesize)
+                if key is not None:
+                    cache.put(key, pieces)
+        torrent['info']['piece length'] = piecesize
+        torrent['info']['pieces'] = pieces
 
-        filelist = []
-        for root, _, filenames in os.walk(path):
-            for filename in filenames:
-                filepath = os.path.join(root, filename)
-                filelist.append(filepath)
+    else:
+        raise FileNotFoundError('Unable to make a torrent of {}, no such file or directory'.format(path))
+
+    return torrent
 
-                fileinfo = {'length': os.path.getsize(filepath),
-                            'path': filepath.split(os.sep)[1:]} #Del root dir
 
-                torrent['info']['files'].append(fileinfo)
+def mktorrent(path, outfile, tracker=None, piecesize=None, private=True, magnet=False, source=None, cache=None):
+    """Main function, writes metainfo file, choosing the piece size unless given"""
 
-        torrent['info']['pieces'] = makePieces(filelist, piecesize)
+    torrent = buildTorrent(path, tracker, piecesize, private, source, cache)
 
     # Write metainfo file
     with open(outfile,'wb') as outpt:
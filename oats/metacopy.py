@@ -1,4 +1,6 @@
 import mutagen
+import mutagen.id3
+import mutagen.oggopus
 from mutagen.easyid3 import EasyID3
 import sys
 
@@ -6,18 +8,61 @@ def main():
     src = mutagen.File(sys.argv[1], easy=True)
     dest = mutagen.File(sys.argv[2], easy=True)
 
-    for tag in src:
+    #Any further arguments are tag overrides of the form TAG=VALUE
+    overrides = {}
+    for arg in sys.argv[3:]:
+        tag, _sep, value = arg.partition('=')
+        overrides[tag.lower()] = value
+
+    if src is not None and src.tags is not None:
+        for tag in src:
+            if tag in EasyID3.valid_keys.keys() and tag not in overrides:
+                dest[tag] = src[tag]
+
+    for tag, value in overrides.items():
         if tag in EasyID3.valid_keys.keys():
-            dest[tag] = src[tag]
+            dest[tag] = value
 
     #print(EasyID3.valid_keys.keys())
     dest.save()
     dest = mutagen.File(sys.argv[2])
 
-    if len(src.pictures) > 0:
+    if len(getattr(src, 'pictures', [])) > 0:
         apic = mutagen.id3.APIC(mime=src.pictures[0].mime, data=src.pictures[0].data)
         dest.tags.add(apic)
 
     dest.save()
 
+def write_replaygain(path, gains, replaygain_reference=-18.0, r128_reference=-23.0):
+    """
+    Write loudness measurements to the tags of a file. `gains` holds the
+    track (and optionally album) loudness in LUFS and sample peak, as
+    composed by oats.loudness.AlbumLoudness. Opus files are given the
+    R128_*_GAIN tags of RFC 7845, all others REPLAYGAIN_* tags.
+    """
+    dest = mutagen.File(path)
+    if dest is None:
+        return
+    if dest.tags is None:
+        dest.add_tags()
 
+    values = {}
+    for scope in ['track', 'album']:
+        if scope + '_loudness' not in gains:
+            continue
+        if isinstance(dest, mutagen.oggopus.OggOpus):
+            #Q7.8 fixed point gain relative to the EBU R128 reference level
+            gain = r128_reference - gains[scope + '_loudness']
+            values['R128_{}_GAIN'.format(scope.upper())] = str(int(round(gain * 256)))
+        else:
+            gain = replaygain_reference - gains[scope + '_loudness']
+            values['REPLAYGAIN_{}_GAIN'.format(scope.upper())] = '{:.2f} dB'.format(gain)
+            values['REPLAYGAIN_{}_PEAK'.format(scope.upper())] = '{:.6f}'.format(gains[scope + '_peak'])
+
+    if isinstance(dest.tags, mutagen.id3.ID3):
+        for key, value in values.items():
+            dest.tags.add(mutagen.id3.TXXX(encoding=3, desc=key, text=[value]))
+    else:
+        for key, value in values.items():
+            dest.tags[key] = [value]
+    dest.save()
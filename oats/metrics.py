@@ -0,0 +1,243 @@
+"""
+Live metrics for OATS
+
+Counts the tasks of each format as they are planned, started and finished,
+the bytes read and written, the seconds of audio transcoded per codec, the
+rate of torrent hashing and the space taken by files being written, and
+renders them in the Prometheus text format. They may be served over HTTP on
+localhost, or written to a file every few seconds, as for the textfile
+collector of the Prometheus node exporter.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . import maketorrent
+
+#Seconds between rewrites of a metrics file
+WRITE_INTERVAL = 10.0
+#Sources remembered as read, so that the tracks or segments of one source
+#transcoded to the same format only count its bytes once
+RECENT_SOURCES = 256
+#Kinds of task which read their source, and which transcode audio
+READING_KINDS = {'copy', 'remux', 'transcode', 'segment'}
+TRANSCODING_KINDS = {'transcode', 'segment'}
+
+
+def escape(value):
+    """Escape a label value of the Prometheus text format"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics(object):
+    """
+    The metrics of a run, updated by the engine as tasks start and finish
+    (see engine.Engine), and by DestinationResult as tasks are planned. Only
+    tasks belonging to a destination are counted. As targets are only
+    walked once started, `targets_queued` is set to the number of targets
+    waiting to be started. Free space is reported for the `output_dir`, if
+    given.
+    """
+    def __init__(self, output_dir=None):
+        self.output_dir = output_dir
+        self.lock = threading.Lock()
+        self.targets_queued = 0
+        self.formats = {}  # format -> [planned, started, done, failed]
+        self.codecs = {}   # codec -> [seconds of audio, seconds of tasks]
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.running = set()
+        self.recent = OrderedDict()  # (source, format) recently read
+        self.start = time.monotonic()
+
+    def counts(self, task):
+        """The counts of the task's format, or None if it is not counted"""
+        if task.result is None or task.kind == 'destination':
+            return None
+        return self.formats.setdefault(str(task.result.format), [0, 0, 0, 0])
+
+    def planned(self, task):
+        with self.lock:
+            counts = self.counts(task)
+            if counts is not None:
+                counts[0] += 1
+
+    def started(self, task):
+        with self.lock:
+            counts = self.counts(task)
+            if counts is not None:
+                counts[1] += 1
+                self.running.add(task)
+
+    def finished(self, task):
+        #Tasks of no destination, as of measuring the loudness of a source
+        #only copied, are not counted
+        if task.result is None or task.kind == 'destination':
+            return
+        read = 0
+        if task.kind in READING_KINDS and task.source is not None:
+            key = (task.source, str(task.result.format))
+            with self.lock:
+                seen = key in self.recent
+                self.recent[key] = True
+                self.recent.move_to_end(key)
+                if len(self.recent) > RECENT_SOURCES:
+                    self.recent.popitem(last=False)
+            if not seen:
+                read = file_size(task.source)
+        written = 0 if task.failed else sum(file_size(path) for path in task.partials)
+        with self.lock:
+            counts = self.counts(task)
+            if counts is None:
+                return
+            self.running.discard(task)
+            counts[3 if task.failed else 2] += 1
+            self.bytes_read += read
+            self.bytes_written += written
+            if task.kind in TRANSCODING_KINDS and task.work and not task.failed:
+                codec = self.codecs.setdefault(task.result.format.type, [0.0, 0.0])
+                codec[0] += task.work
+                codec[1] += task.elapsed or 0.0
+
+    def render(self):
+        """The metrics in the Prometheus text format"""
+        with self.lock:
+            formats = dict((fmt, list(counts)) for fmt, counts in self.formats.items())
+            codecs = dict((codec, list(seconds)) for codec, seconds in self.codecs.items())
+            bytes_read, bytes_written = self.bytes_read, self.bytes_written
+            running = list(self.running)
+            targets_queued = self.targets_queued
+        scratch = sum(file_size(path) for task in running for path in task.partials)
+        hashed, hashing = maketorrent.hash_stats.totals()
+
+        lines = []
+
+        def metric(name, kind, description, samples):
+            lines.append('# HELP oats_{} {}'.format(name, description))
+            lines.append('# TYPE oats_{} {}'.format(name, kind))
+            for labels, value in samples:
+                label = ','.join('{}="{}"'.format(k, escape(v)) for k, v in labels)
+                lines.append('oats_{}{} {}'.format(name, '{' + label + '}' if label else '', value))
+
+        def per_format(value):
+            return [((('format', fmt),), value(counts)) for fmt, counts in sorted(formats.items())]
+
+        metric('targets_queued', 'gauge', 'Targets submitted and not yet started',
+               [((), targets_queued)])
+        metric('tasks_queued', 'gauge', 'Tasks planned and not yet started',
+               per_format(lambda c: c[0] - c[1]))
+        metric('tasks_in_flight', 'gauge', 'Tasks running',
+               per_format(lambda c: c[1] - c[2] - c[3]))
+        metric('tasks_done_total', 'counter', 'Tasks finished successfully',
+               per_format(lambda c: c[2]))
+        metric('tasks_failed_total', 'counter', 'Tasks failed',
+               per_format(lambda c: c[3]))
+        metric('read_bytes_total', 'counter', 'Bytes of sources read', [((), bytes_read)])
+        metric('written_bytes_total', 'counter', 'Bytes of outputs written', [((), bytes_written)])
+        metric('audio_seconds_total', 'counter', 'Seconds of audio transcoded',
+               [((('codec', codec),), round(seconds[0], 3)) for codec, seconds in sorted(codecs.items())])
+        metric('realtime_factor', 'gauge', 'Seconds of audio transcoded per second of a task',
+               [((('codec', codec),), round(seconds[0] / seconds[1], 3))
+                for codec, seconds in sorted(codecs.items()) if seconds[1] > 0])
+        metric('hashed_bytes_total', 'counter', 'Bytes hashed for torrents', [((), hashed)])
+        metric('hash_megabytes_per_second', 'gauge', 'Torrent hashing rate of a thread',
+               [((), round(hashed / hashing / 1e6, 3) if hashing > 0 else 0)])
+        metric('scratch_bytes', 'gauge', 'Bytes of files being written by running tasks',
+               [((), scratch)])
+        if self.output_dir is not None:
+            try:
+                free = shutil.disk_usage(self.output_dir).free
+            except OSError:
+                free = None
+            if free is not None:
+                metric('output_free_bytes', 'gauge', 'Free space in the output directory', [((), free)])
+        metric('uptime_seconds', 'gauge', 'Seconds since the run started',
+               [((), round(time.monotonic() - self.start, 3))])
+        return '\n'.join(lines) + '\n'
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class MetricsServer(object):
+    """Serves the metrics over HTTP on localhost, from a background thread"""
+    def __init__(self, metrics, port):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='oats-metrics', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsFile(object):
+    """
+    Rewrites a file with the metrics every `interval` seconds, and once more
+    when stopped. The file is replaced atomically, so it is never read half
+    written.
+    """
+    def __init__(self, metrics, path, interval=WRITE_INTERVAL):
+        self.metrics = metrics
+        self.path = os.path.abspath(path)
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='oats-metrics', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        directory = os.path.dirname(self.path)
+        try:
+            fd, temppath = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as metrics_file:
+                metrics_file.write(self.metrics.render())
+            os.replace(temppath, self.path)
+        except OSError as e:
+            print('Unable to write metrics to {}: {}'.format(self.path, e))
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+
+
+def exporter(metrics, destination):
+    """
+    The exporter of the metrics to a destination: a port number to serve
+    them on localhost, or otherwise the path of a file to write them to.
+    """
+    if destination.isdigit():
+        return MetricsServer(metrics, int(destination))
+    return MetricsFile(metrics, destination)
@@ -0,0 +1,390 @@
+"""
+Preflight validation of source files for OATS
+
+Checks the container structure of source files in pure Python, so that
+truncated or corrupt sources are found before any transcoding begins. Each
+check returns a list of problem descriptions, empty if the file looks sound.
+"""
+
+import hashlib
+import os
+import struct
+import subprocess
+import zlib
+
+#Number of bytes from the end of a FLAC file searched for the final frame,
+#larger than the biggest frame of common streams
+FLAC_TAIL_SEARCH = 2**18
+#Bytes of an MP3 file read at once while following its frames
+MP3_READ_SIZE = 2**16
+
+MP3_BITRATES = {  # (version, layer) -> kbps by index
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+
+def _crc8_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return table
+
+
+CRC8_TABLE = _crc8_table()
+#Each byte with its bits in reverse order, for bytes.translate
+BIT_REVERSED = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+
+
+def _crc16_table():
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x8005) & 0xFFFF if crc & 0x8000 else (crc << 1) & 0xFFFF
+        table.append(crc)
+    return table
+
+
+CRC16_TABLE = _crc16_table()
+
+
+def crc16(data):
+    crc = 0
+    table = CRC16_TABLE
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ byte]
+    return crc
+
+
+def crc8(data):
+    crc = 0
+    for byte in data:
+        crc = CRC8_TABLE[crc ^ byte]
+    return crc
+
+
+def ogg_crc(data):
+    """
+    The Ogg page CRC-32, computed by zlib. Ogg uses the polynomial of zlib's
+    CRC-32 unreflected, with no initial or final inversion, so the bits of
+    each byte are reversed going in and those of the CRC coming out, and the
+    inversions zlib makes are undone.
+    """
+    crc = zlib.crc32(data.translate(BIT_REVERSED), 0xFFFFFFFF) ^ 0xFFFFFFFF
+    return int('{:032b}'.format(crc)[::-1], 2)
+
+
+def skip_id3v2(f):
+    """Seek past an ID3v2 tag at the start of a file, if there is one."""
+    header = f.read(10)
+    if len(header) == 10 and header[:3] == b'ID3':
+        size = 0
+        for byte in header[6:10]:
+            size = (size << 7) | (byte & 0x7F)
+        footer = 10 if header[5] & 0x10 else 0
+        f.seek(10 + size + footer)
+    else:
+        f.seek(0)
+
+
+def flac_frame_header_valid(data, offset):
+    """
+    Check whether a FLAC frame header begins at `offset` of `data`, by its
+    sync code and CRC-8.
+    """
+    if offset + 4 > len(data) or data[offset] != 0xFF or data[offset + 1] & 0xFE != 0xF8:
+        return False
+    blocksize_code = data[offset + 2] >> 4
+    rate_code = data[offset + 2] & 0x0F
+    if blocksize_code == 0 or rate_code == 0x0F:
+        return False
+    #The coded frame or sample number is UTF-8 style, 1 to 7 bytes
+    pos = offset + 4
+    if pos >= len(data):
+        return False
+    lead = data[pos]
+    if lead < 0x80:
+        length = 1
+    elif lead >= 0xFE:
+        length = 7
+    else:
+        length = 0
+        while lead & (0x80 >> length):
+            length += 1
+    pos += length
+    if blocksize_code in (6, 7):
+        pos += blocksize_code - 5
+    if rate_code in (12, 13, 14):
+        pos += 1 if rate_code == 12 else 2
+    if pos >= len(data):
+        return False
+    return crc8(data[offset:pos]) == data[pos]
+
+
+def check_flac(path, verify_md5=False):
+    problems = []
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        skip_id3v2(f)
+        if f.read(4) != b'fLaC':
+            return ['missing fLaC stream marker']
+        streaminfo = None
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                return problems + ['metadata blocks are truncated']
+            last = header[0] & 0x80
+            block_type = header[0] & 0x7F
+            length = int.from_bytes(header[1:4], 'big')
+            if f.tell() + length > size:
+                return problems + ['metadata block {} runs past the end of the file'.format(block_type)]
+            if block_type == 0:
+                streaminfo = f.read(length)
+            else:
+                f.seek(length, 1)
+            if last:
+                break
+        if streaminfo is None or len(streaminfo) < 34:
+            return problems + ['missing STREAMINFO block']
+
+        first_frame = f.tell()
+        if not flac_frame_header_valid(f.read(16), 0):
+            problems.append('no valid frame header at the start of the audio')
+
+        #The file should end with a complete frame, its CRC-16 in the last
+        #two bytes. Frame headers are searched for from the end, as a sync
+        #code may also occur by chance within frame data.
+        f.seek(max(first_frame, size - FLAC_TAIL_SEARCH))
+        tail = f.read()
+        if len(tail) > 128 and tail[-128:-125] == b'TAG':  # ID3v1
+            tail = tail[:-128]
+        candidates = [i for i in range(len(tail) - 2, -1, -1)
+                      if tail[i] == 0xFF and flac_frame_header_valid(tail, i)]
+        expected = int.from_bytes(tail[-2:], 'big')
+        if not candidates:
+            problems.append('no frame header near the end of the file, likely truncated')
+        elif not any(crc16(tail[i:-2]) == expected for i in candidates):
+            problems.append('the last frame is incomplete, likely truncated')
+
+    packed = int.from_bytes(streaminfo[10:18], 'big')
+    sample_rate = packed >> 44
+    bits = ((packed >> 36) & 0x1F) + 1
+    total_samples = packed & 0xFFFFFFFFF
+    md5 = streaminfo[18:34]
+    if sample_rate == 0:
+        problems.append('STREAMINFO has an invalid sample rate of 0')
+    if total_samples == 0:
+        problems.append('STREAMINFO reports no samples')
+    if verify_md5 and not problems and md5 != bytes(16):
+        decoded = decoded_md5(path, bits)
+        if decoded is None:
+            problems.append('could not be decoded for MD5 verification')
+        elif decoded != md5.hex():
+            problems.append('decoded audio does not match the STREAMINFO MD5')
+    return problems
+
+
+def decoded_md5(path, bits):
+    """
+    Decode a FLAC file with FFmpeg and return the MD5 of the audio in the
+    form hashed by the encoder: signed little-endian samples, each a whole
+    number of bytes wide.
+    """
+    codec = {8: 'pcm_s8', 16: 'pcm_s16le', 24: 'pcm_s24le', 32: 'pcm_s32le'}.get((bits + 7) // 8 * 8)
+    fmt = {'pcm_s8': 's8', 'pcm_s16le': 's16le', 'pcm_s24le': 's24le', 'pcm_s32le': 's32le'}[codec]
+    command = ['ffmpeg', '-v', 'error', '-threads', '1', '-i', path, '-map', '0:a',
+               '-c:a', codec, '-f', fmt, '-']
+    md5 = hashlib.md5()
+    try:
+        with subprocess.Popen(command, stdin=subprocess.DEVNULL,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as proc:
+            for chunk in iter(lambda: proc.stdout.read(2**20), b''):
+                md5.update(chunk)
+    except OSError:
+        return None
+    if proc.returncode != 0:
+        return None
+    return md5.hexdigest()
+
+
+def check_wav(path):
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            return ['missing RIFF WAVE header']
+        riff_size = struct.unpack('<I', header[4:8])[0]
+        problems = []
+        if riff_size + 8 > size:
+            problems.append('RIFF size {} exceeds the file size {}, likely truncated'.format(riff_size + 8, size))
+        found_fmt = False
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                return problems + ['no data chunk']
+            chunk_id, chunk_size = struct.unpack('<4sI', chunk)
+            if chunk_id == b'fmt ':
+                found_fmt = True
+            if chunk_id == b'data':
+                if not found_fmt:
+                    problems.append('data chunk precedes the fmt chunk')
+                if f.tell() + chunk_size > size:
+                    problems.append('data chunk size exceeds the file size, likely truncated')
+                return problems
+            f.seek(chunk_size + chunk_size % 2, 1)
+
+
+def check_ogg(path):
+    problems = []
+    saw_eos = False
+    pages = 0
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(27)
+            if not header:
+                break
+            if len(header) < 27 or header[:4] != b'OggS':
+                return problems + ['broken Ogg page at offset {}'.format(f.tell() - len(header))]
+            segments = f.read(header[26])
+            body_size = sum(segments)
+            body = f.read(body_size)
+            if len(segments) < header[26] or len(body) < body_size:
+                return problems + ['last Ogg page is truncated']
+            page = header[:22] + b'\0\0\0\0' + header[26:] + segments + body
+            if ogg_crc(page) != struct.unpack('<I', header[22:26])[0]:
+                problems.append('Ogg page {} fails its CRC check'.format(pages))
+            saw_eos = saw_eos or bool(header[5] & 0x04)
+            pages += 1
+    if pages == 0:
+        problems.append('no Ogg pages')
+    elif not saw_eos:
+        problems.append('no end of stream page, likely truncated')
+    return problems
+
+
+def mp3_frame_length(header):
+    """Return the length of the MPEG audio frame with this 4 byte header, or None."""
+    if header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version_bits = (header[1] >> 3) & 0x03
+    layer_bits = (header[1] >> 1) & 0x03
+    bitrate_index = header[2] >> 4
+    rate_index = (header[2] >> 2) & 0x03
+    if version_bits == 1 or layer_bits == 0 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    version = 1 if version_bits == 3 else 2
+    layer = 4 - layer_bits
+    bitrate = MP3_BITRATES[(version, layer)][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version_bits][rate_index]
+    padding = (header[2] >> 1) & 0x01
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4
+    if layer == 3 and version == 2:
+        return 72 * bitrate // sample_rate + padding
+    return 144 * bitrate // sample_rate + padding
+
+
+def check_mp3(path):
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        skip_id3v2(f)
+        start = f.tell()
+        #Trailing ID3v1 and APEv2 tags are not audio
+        end = size
+        f.seek(max(start, end - 128))
+        if end - start >= 128 and f.read(3) == b'TAG':
+            end -= 128
+        f.seek(max(start, end - 32))
+        footer = f.read(32)
+        if end - start >= 32 and footer[:8] == b'APETAGEX':
+            #The tag size includes the footer, but not the header if it has one
+            tag_size, flags = struct.unpack('<I4xI', footer[12:24])
+            end -= tag_size + (32 if flags & 0x80000000 else 0)
+        if end <= start:
+            return ['no audio after the tags']
+
+        pos = start
+        frames = 0
+        data, data_start = b'', start  # The data read, from this offset of the file
+        while pos + 4 <= end:
+            if pos + 4 > data_start + len(data):
+                f.seek(pos)
+                data, data_start = f.read(MP3_READ_SIZE), pos
+            length = mp3_frame_length(data[pos - data_start:pos - data_start + 4])
+            if length is None:
+                if frames == 0 and pos < start + 4096:  # Tolerate junk ahead of the first frame
+                    pos += 1
+                    continue
+                return ['lost MPEG frame sync at offset {} after {} frames'.format(pos, frames)]
+            pos += length
+            frames += 1
+    if frames == 0:
+        return ['no MPEG audio frames']
+    if pos > end:
+        return ['last MPEG frame is truncated']
+    return []
+
+
+def check_mp4(path):
+    size = os.path.getsize(path)
+    problems = []
+    found_moov = False
+    with open(path, 'rb') as f:
+        offset = 0
+        while offset < size:
+            f.seek(offset)
+            header = f.read(8)
+            if len(header) < 8:
+                return ['truncated atom header at offset {}'.format(offset)]
+            atom_size, atom_type = struct.unpack('>I4s', header)
+            if atom_size == 1:
+                atom_size = struct.unpack('>Q', f.read(8))[0]
+            elif atom_size == 0:
+                atom_size = size - offset
+            if atom_size < 8 or offset + atom_size > size:
+                return problems + ['atom {} runs past the end of the file, likely truncated'.format(atom_type)]
+            found_moov = found_moov or atom_type == b'moov'
+            offset += atom_size
+    if not found_moov:
+        problems.append('no moov atom')
+    return problems
+
+
+CHECKS = {'.flac': check_flac,
+          '.wav': check_wav,
+          '.ogg': check_ogg,
+          '.opus': check_ogg,
+          '.vorbis': check_ogg,
+          '.mp3': check_mp3,
+          '.m4a': check_mp4,
+          '.alac': check_mp4,
+          '.aac': None,  # ADTS streams have no container to check
+          }
+
+
+def check_file(path, verify_md5=False):
+    """
+    Check a single source file, returning a tuple of the path and a list of
+    problems found with it.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    check = CHECKS.get(ext)
+    if check is None:
+        return path, []
+    try:
+        if check is check_flac:
+            return path, check_flac(path, verify_md5=verify_md5)
+        return path, check(path)
+    except OSError as e:
+        return path, ['unreadable: {}'.format(e)]
+    except (struct.error, IndexError) as e:
+        return path, ['malformed: {}'.format(e)]
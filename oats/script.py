@@ -6,6 +6,7 @@ parallelizes transcodes, is cross-platform, and makes torrents if directed.
 Usage:
   oats mkconfig [<file>]
   oats mktorrent [options] <target> ...
+  oats plan [options] <target> ...
   oats [options] <target> ...
   oats (--help | --version | --show-formats | --show-codecs)
 
@@ -16,9 +17,95 @@ Options:
   -o --output-dir=<dir>    A directory path where transcodes will be put.
   -p --processes=<count>   Set the number of processes to employ. A value of 0
                            will set equivalent to number of CPU cores. Useful
-                           for throttling or if autodetection is incorrect.
+                           for throttling or if autodetection is incorrect. A
+                           value of "auto" adjusts the number of processes
+                           during the run to that of the best throughput.
   -l --list-file           Process targets as list files, each line of the file
                            containing a path to a directory to be transcoded.
+  -x --split-cue=<bool>    Split album images described by a CUE sheet into a
+                           transcode per track, tagged from the CUE sheet.
+                           Boolean-ish values expected to enable: one of
+                           {1. True, t}, others will disable.
+  -d --chunk-duration=<s>  Encode sources longer than twice this many seconds
+                           as segments of this length in parallel, joined
+                           losslessly afterwards. Only used for formats whose
+                           segments join without gaps (FLAC), at the sample
+                           rate and bit depth of the source. A value of 0
+                           disables chunking.
+  -r --replaygain=<bool>   Measure the loudness of each album from the audio
+                           decoded for transcoding, and write ReplayGain 2.0
+                           track and album tags (R128 tags for Opus) to the
+                           transcodes. Requires NumPy. Boolean-ish values
+                           expected to enable: one of {1. True, t}, others
+                           will disable.
+  -P --preflight=<mode>    Check the structure of the source files of each
+                           target in parallel before it is transcoded, reading
+                           them in full. One of "off" (the default), "report"
+                           to list bad files, "exclude" to also leave them out
+                           of the transcodes, or "abort" to queue no further
+                           targets once any are found.
+  -M --verify-md5=<bool>   During preflight, also decode FLAC sources to verify
+                           them against their STREAMINFO MD5. Boolean-ish
+                           values expected to enable: one of {1. True, t},
+                           others will disable.
+  -k --task-timeout=<s>    Kill and fail any single task which takes longer than
+                           this many seconds. A value of 0 disables the limit.
+  -n --nice=<n>            Run encoders and other tools at this nice value, from
+                           0 (normal priority) to 19 (lowest priority).
+  -I --ionice=<class>      Run encoders and other tools in this I/O scheduling
+                           class, one of "none", "idle", "best-effort" or
+                           "realtime", optionally with a level from 0 (highest)
+                           to 7 (lowest) like "best-effort:7". Requires the
+                           ionice tool.
+  -A --cpus=<cpu-list>     Pin encoders and other tools to these CPUs, a list
+                           like "0-3,6". Unless --processes is given, one
+                           process is run per CPU. Linux only.
+  -m --memory-limit=<MiB>  Limit the address space of each encoder and other
+                           tool to this many MiB, failing any which exceed it.
+                           A value of 0 disables the limit.
+  -D --io-per-device=<n>   The most I/O heavy pieces of work, like hashing
+                           torrents, preflight checks and copying files, to run
+                           at once on each disk, so that spinning disks are
+                           read in sequence rather than seeking between files.
+                           Encodes are not limited. "auto" runs one at a time
+                           on spinning disks and does not limit other devices
+                           (Linux only), 0 disables the limit.
+  -S --shard=<i/N>         Process only the i-th of N shares of the work, so
+                           that N machines given the same targets each do a
+                           disjoint part. Source files are shared out by a
+                           stable hash of their path within the target, or
+                           whole targets when making torrents or ReplayGain
+                           tags. The plan subcommand prints the tasks of every
+                           shard, with cost estimates, as JSON.
+  -O --metrics=<dest>      Report live metrics of the run in the Prometheus text
+                           format: the tasks queued, running, done and failed
+                           per format, bytes read and written, realtime factor
+                           per codec, torrent hashing rate and space taken by
+                           files being written. A port number serves them over
+                           HTTP on localhost, anything else is the path of a
+                           file rewritten every 10 seconds. Empty disables.
+  -X --transcode-cache=<dir>
+                           A directory where encoded outputs are cached by the
+                           content of their source's audio, so that identical
+                           tracks, as on compilations and re-releases, are
+                           only encoded once. Cached outputs are copied (or
+                           reflinked) and tagged from their source. "default"
+                           uses a directory in the user cache, "off" disables
+                           the cache.
+  -Z --transcode-cache-size=<MiB>
+                           The most space the transcode cache may take, beyond
+                           which the least recently used outputs are evicted.
+  -E --profile=<profiles>
+                           The effort of encoders, trading the time taken to
+                           encode for smaller or better outputs: "fast",
+                           "balanced" or "archival" (the slowest settings of
+                           each codec). Formats may be given their own profile
+                           after the default, like "balanced,MP3 CBR 128=fast".
+  -e --force-encode=<bool>
+                           Always transcode, even when a source already
+                           satisfies the target format and could be copied or
+                           remuxed as-is. Boolean-ish values expected to
+                           enable: one of {1. True, t}, others will disable.
   -F --show-formats        Print out the list of formats known and available to
                            OATS on your system.
   -C --show-codecs         Print out the list of codecs useable by OATS on your
@@ -36,25 +123,60 @@ Torrent Options:
   -t --torrent-dir=<dir>   A directory path where torrent files will be placed.
   -s --source=<str>        A special short identifier string used by some
                            trackers to help cross-seeding.
+  -L --piece-length=<KiB>  The piece length of torrents, a power of two of at
+                           least 16 KiB. "auto" chooses the shortest giving no
+                           more than 1500 pieces, between 32 KiB and 16 MiB.
+  -W --hash-early=<bool>   Hash the torrent pieces of each output as soon as it
+                           is written, while it is likely still cached in
+                           memory, rather than reading every output back once
+                           the destination is done. Not used with ReplayGain,
+                           which rewrites the tags of outputs at the end.
+                           Boolean-ish values expected to enable: one of
+                           {1. True, t}, others will disable.
+  -H --hash-cache=<dir>    A directory where the piece hashes of torrents are
+                           cached, so that re-creating a torrent of unchanged
+                           files with another announce url or source does not
+                           hash them again. Defaults to a directory in the
+                           user cache, "off" disables the cache.
 """
 
 #Non-Standard Libs
 from docopt import docopt
+import mutagen
 from . import maketorrent, __version__
 from . import codec
+from .engine import Engine, ConcurrencyController, DeviceScheduler, ProcessLimits, parse_cpu_list
+from .engine import IONICE_CLASSES, IO_LOOKAHEAD
+from . import cue
+from . import flacjoin
+from . import metacopy
+from . import metrics
+from . import preflight
+from .transcodecache import TranscodeCache, CachedTranscode
+try:
+    from . import loudness
+except ImportError:  # NumPy is only required for ReplayGain
+    loudness = None
 
 #Standard Libs
+import asyncio
+import hashlib
+import json
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from configparser import ConfigParser, ExtendedInterpolation
-from functools import wraps
+from contextlib import nullcontext, redirect_stdout
+from functools import partial, wraps
 from multiprocessing import Pool
-from multiprocessing.pool import ThreadPool
 import os
+import math
 import platform
 from pprint import pprint
+import queue
 import re
-import shlex
-import subprocess
+import shutil
 import sys
+import threading
+import time
 
 
 class InvalidConfiguration(Exception):
@@ -64,9 +186,10 @@ class NotSupportedError(Exception):
     pass
 
 class Format(object):
-    def __init__(self, type, subtype):
+    def __init__(self, type, subtype, profile=codec.DEFAULT_PROFILE):
         self.type = type
         self.subtype = subtype
+        self.profile = profile
 
     def __str__(self):
         if self.subtype == '':
@@ -82,38 +205,310 @@ class Format(object):
         return cls(t, s)
 
 class Task(object):
-    def __init__(self, *commands):
-        self.commands = commands
+    """
+    A Task is a sequence of commands run one after the other. A command is
+    either a list of arguments, or a callable accepting a `threads` keyword
+    which returns one, so that the thread count may be decided by the budget
+    just before each command is run rather than when the task is created. A
+    callable which does its work in-process returns None instead.
+
+    Once a command fails the task is marked as failed, and only its removal
+    commands are still run so that no intermediate files are left. Any
+    `partials`, the files the task writes, are removed if it fails or is
+    interrupted. The failure is passed on to the follow-up tasks of any groups
+    it belongs to.
+
+    A task with a `destination` marks the completion of all transcodes to
+    that destination directory. The `output` of a task is the file it makes
+    in the destination, if any, and its `result` is the DestinationResult of
+    the destination it belongs to. Its `work` is the seconds of audio it
+    transcodes, by which the throughput of transcoding is measured. The
+    `kind` and `source` of a task describe it in plans.
+
+    Rather than its own commands, a task may have a `template` shared with
+    many others, such as a TranscodeTemplate, from which its commands are
+    composed with its `source`, `output` and `args` only as it is run. As
+    millions of tasks may be queued, tasks have no attribute dictionary.
+    """
+    __slots__ = ('commands', 'template', 'args', 'partials', 'output', 'kind', 'source',
+                 'groups', 'failed', 'elapsed', 'destination', 'result', 'work')
 
-    def __call__(self):
-        for command in self.commands:
-            if platform.system() == 'Windows' and command[0] in [COPY, RM]:
-                shell = True
-            else:
-                shell = False
-            try:
-                if shell and platform.system() != 'Windows':
-                    command = ' '.join([shlex.quote(w) for w in command])
-                subprocess.check_call(command,
-                                      stdin=subprocess.DEVNULL,
-                                      stdout=subprocess.DEVNULL,
-                                      stderr=subprocess.DEVNULL,
-                                      shell=shell)
-            except subprocess.CalledProcessError as e:
-                print('{} reports an error: code {}'.format(e.cmd, e.returncode))
+    def __init__(self, *commands, template=None, args=(), partials=(), output=None, kind=None, source=None):
+        self.commands = commands
+        self.template = template
+        self.args = args
+        self.partials = partials
+        self.output = output
+        self.kind = kind
+        self.source = source
+        self.groups = ()
+        self.failed = False
+        self.elapsed = None
+        self.destination = None
+        self.result = None
+        self.work = 0.0
+
+    def all_commands(self):
+        """Every command of the task, composed from its template if it has one"""
+        if self.template is not None:
+            return self.template.commands(self.source, self.output, *self.args)
+        return self.commands
+
+    def iter_commands(self):
+        for command in self.all_commands():
+            if self.failed and getattr(command, 'func', None) is not remove_files:
+                continue
+            yield command
+
+    def finish(self):
+        """
+        Mark the task as done in its groups, returning the list of follow-up
+        tasks which are now ready to run.
+        """
+        followups = []
+        for group in self.groups:
+            followup = group.done(self)
+            if followup is not None:
+                followups.append(followup)
+        return followups
 
     def __repr__(self):
         fmt = 'Task:\n'
-        for command in self.commands:
-            fmt+= ('     {}\n'.format(' '.join(command)))
+        for command in self.all_commands():
+            if callable(command):
+                fmt+= ('     {!r}\n'.format(command))
+            else:
+                fmt+= ('     {}\n'.format(' '.join(command)))
         return fmt
 
-if platform.system() == 'Windows':
-    COPY = 'copy'
-    RM = 'del'
-else:
-    COPY = 'cp'
-    RM = 'rm'
+
+class TaskGroup(object):
+    """
+    A TaskGroup holds back a follow-up task until every task added to it is
+    done and the group has been closed to further additions. If any of the
+    tasks failed, the follow-up is released already marked as failed.
+    """
+    __slots__ = ('followup', 'pending', 'closed', 'failed', 'lock')
+
+    def __init__(self, followup):
+        self.followup = followup
+        self.pending = 0
+        self.closed = False
+        self.failed = False
+        self.lock = threading.Lock()
+
+    def add(self, task):
+        with self.lock:
+            self.pending += 1
+        task.groups += (self,)
+        return task
+
+    def close(self):
+        """Close the group, returning the follow-up task if it is ready."""
+        with self.lock:
+            self.closed = True
+            return self._release()
+
+    def done(self, task):
+        with self.lock:
+            self.pending -= 1
+            self.failed = self.failed or task.failed
+            return self._release()
+
+    def _release(self):
+        if not self.closed or self.pending > 0 or self.followup is None:
+            return None
+        followup, self.followup = self.followup, None
+        followup.failed = followup.failed or self.failed
+        return followup
+
+
+def destination_task(result):
+    """A task with no commands, marking that a destination is complete"""
+    task = Task(kind='destination')
+    task.destination = result.destination
+    task.result = result
+    return task
+
+
+class EarlyHasher(object):
+    """
+    Hashes the torrent pieces of a destination's outputs as each is written,
+    in the order the files will have in the torrent. That order is only
+    known once every output of the destination has been planned, so outputs
+    written before then are hashed at that point. After that, each output is
+    hashed as soon as it and every output before it in the order are written.
+
+    Unless a `piece_length` is given, that of the torrent (see
+    maketorrent.pieceLength) is chosen once the first output is to be
+    hashed, by an estimate of the destination's total size. Outputs not yet
+    written are estimated from their `sources`, scaled by how much smaller
+    the transcodes written so far are than theirs. Should the destination
+    turn out to need another piece length, its pieces are hashed again once
+    it is done, so that the torrent is the same as one made afterwards.
+    """
+    def __init__(self, piece_length=None):
+        self.piece_length = piece_length
+        self.sources = {}  # output -> (source, whether it is transcoded)
+        self.hasher = None
+        self.order = None
+        self.position = 0
+        self.written = set()
+        self.lock = threading.Lock()  # Guards the order and written outputs
+        self.hashing = threading.Lock()
+
+    def plan(self, destination, outputs):
+        order = sorted(set(outputs),
+                       key=lambda output: maketorrent.torrentOrder(os.path.relpath(output, destination)))
+        with self.lock:
+            self.order = order
+
+    def done(self, output):
+        with self.lock:
+            self.written.add(output)
+
+    def estimate(self):
+        """
+        Estimate the total size of the outputs, or return None until one of
+        the transcodes among them has been written to estimate the rest by.
+        A source split into several outputs, as by a CUE sheet, is shared
+        among them evenly.
+        """
+        with self.lock:
+            written = set(self.written)
+        counts = {}
+        for source, _transcoded in self.sources.values():
+            counts[source] = counts.get(source, 0) + 1
+        shares = dict((source, file_size(source) / count) for source, count in counts.items())
+        transcoded = [output for output, (_source, transcoded) in self.sources.items() if transcoded]
+        if transcoded and not written.intersection(transcoded):
+            return None
+        made = sum(file_size(output) for output in transcoded if output in written)
+        expected = sum(shares[self.sources[output][0]] for output in transcoded if output in written)
+        ratio = made / expected if expected else 1.0
+        total = 0
+        for output in self.order:
+            if output in written:
+                total += file_size(output)
+            elif output in self.sources:
+                source, transcoded = self.sources[output]
+                total += shares[source] * (ratio if transcoded else 1.0)
+        return int(total)
+
+    def advance(self):
+        """Hash the outputs which are next in the order and written, in a worker thread"""
+        with self.hashing:
+            if self.hasher is None:
+                with self.lock:
+                    if self.order is None or not self.order or self.order[0] not in self.written:
+                        return
+                piece_length = self.piece_length
+                if piece_length is None:
+                    total = self.estimate()
+                    if total is None:
+                        return
+                    piece_length = maketorrent.pieceLength(total)
+                self.hasher = maketorrent.PieceHasher(piece_length)
+            while True:
+                with self.lock:
+                    if self.position >= len(self.order):
+                        return
+                    output = self.order[self.position]
+                    if output not in self.written:
+                        return
+                try:
+                    self.hasher.add(output)
+                except OSError:  # The pieces are hashed from scratch instead
+                    self.hasher.broken = True
+                    return
+                self.position += 1
+
+
+class DestinationResult(object):
+    """
+    The outcome of transcoding a target to one format. `outputs` lists the
+    files made in the destination and `failures` the files which could not
+    be made. `elapsed` is the total time spent on the destination's tasks and
+    `duration` the time from its submission until it was done, in seconds.
+    `torrent` is the path of the torrent made of the destination, or if
+    making it failed, `torrent_error` is the exception raised. `planned`
+    lists every output the destination's tasks will make.
+    """
+    def __init__(self, target, fmt, destination):
+        self.target = target
+        self.format = fmt
+        self.destination = destination
+        self.outputs = []
+        self.failures = []
+        self.failed = False
+        self.elapsed = 0.0
+        self.duration = None
+        self.torrent = None
+        self.torrent_error = None
+        self.submitted = time.monotonic()
+        self.planned = []
+        self.early = None  # EarlyHasher of the destination's torrent
+        self.metrics = None  # Metrics counting the destination's tasks
+
+    def add(self, task):
+        """Make a task one of the destination's"""
+        task.result = self
+        if task.output is not None:
+            self.planned.append(task.output)
+            if self.early is not None and task.source is not None:
+                self.early.sources[task.output] = (task.source, task.kind in ('transcode', 'join'))
+        if self.metrics is not None:
+            self.metrics.planned(task)
+        return task
+
+    def record(self, task):
+        """Account for a finished task of the destination"""
+        self.elapsed += task.elapsed or 0.0
+        if task.failed:
+            self.failed = True
+            if task.output is not None:
+                self.failures.append(task.output)
+        elif task.output is not None:
+            self.outputs.append(task.output)
+
+    def __repr__(self):
+        return '<DestinationResult {} [{}]: {} outputs, {} failures>'.format(
+            self.destination, self.format, len(self.outputs), len(self.failures))
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def copy_file(source, dest, threads=1):
+    """Copy a file in-process, as a task command"""
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    shutil.copyfile(source, dest)
+
+
+def remux(source, dest, threads=1):
+    """Return the command remuxing a source, once its directory is made"""
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    return FFMPEG.remux(source, dest, threads=threads)
+
+
+def decode_wav(decoder, source, wav_dest, threads=1):
+    """Return the command decoding a whole source to wav, once its directory is made"""
+    os.makedirs(os.path.dirname(wav_dest), exist_ok=True)
+    return decoder.decode(source, wav_dest, threads=threads)
+
+
+def remove_files(*paths, threads=1):
+    """Remove files in-process, as a task command, ignoring any missing"""
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
 
 AAC_ENCODER = 'aac'
 #To use the Fraunhofer FDK AAC codec library, comment the line above and
@@ -125,6 +520,7 @@ AAC_ENCODER = 'aac'
 
 ext_codec_full_map = {'.mp3'   : [codec.LAME, codec.FFmpegMP3],
                       '.flac'  : [codec.FFmpegFLAC],
+                      '.wav'   : [codec.FFmpeg],
                       '.m4a'   : [codec.FFmpeg],
                       '.alac'  : [codec.FFmpeg],
                       '.aac'   : [codec.FFmpeg],
@@ -137,7 +533,7 @@ for key in ext_codec_full_map:
     ext_codec_map[key] = [codec for codec in ext_codec_full_map[key] if codec.on_system()]
 
 format_codec_full_map = {
-    'FLAC'  : [codec.FFmpegFLAC],
+    'FLAC'  : [codec.FlacTools, codec.FFmpegFLAC],
     'MP3'   : [codec.LAME, codec.FFmpegMP3],
     'OPUS'  : [codec.OpusTools, codec.FFmpegOpus],
     'VORBIS': [codec.OggVorbis, codec.FFmpegVorbis],
@@ -146,12 +542,19 @@ format_codec_map = {}
 for key in format_codec_full_map:
     format_codec_map[key] = [codec for codec in format_codec_full_map[key] if codec.on_system()]
 
+#Stream inspection tool, used to detect sources that need no transcoding
+PROBE = codec.FFprobe if codec.FFprobe.on_system() else None
+FFMPEG = codec.FFmpeg if codec.FFmpeg.on_system() else None
+
 #File extension codec classification sets
 #NB: .m4a may contain either lossless or lossy encoding, beware
 LOSSLESS_EXT = {'.flac', '.wav', '.m4a', '.alac'}
 LOSSY_EXT = {'.mp3', '.aac', '.opus', '.ogg', '.vorbis'}
 AUDIO_EXTENSIONS = LOSSLESS_EXT.union(LOSSY_EXT)
 
+#Targets a Transcoder holds waiting to be started before submissions block
+QUEUE_SIZE = 4
+
 def get_format_regex():
     #Compose the capture grouping for all of the available codecs, note that
     #this makes use of the full map of codecs
@@ -215,11 +618,31 @@ def initialize_configuration(config):
     config['OATS'] = {'--processes': '0',
                       '--output-dir': '.',
                       '--formats': 'MP3 CBR 320,MP3 VBR 0',
+                      '--profile': codec.DEFAULT_PROFILE,
                       '--list-file': 'False',
+                      '--force-encode': 'False',
+                      '--split-cue': 'True',
+                      '--chunk-duration': '0',
+                      '--replaygain': 'False',
+                      '--preflight': 'off',
+                      '--task-timeout': '0',
+                      '--metrics': '',
+                      '--shard': '',
+                      '--nice': '0',
+                      '--ionice': 'none',
+                      '--cpus': '',
+                      '--memory-limit': '0',
+                      '--io-per-device': 'auto',
+                      '--verify-md5': 'False',
                       '--torrent': 'False',
                       '--torrent-dir': '.',
                       '--announce-url': 'None',
-                      '--source': 'None'}
+                      '--source': 'None',
+                      '--hash-cache': '',
+                      '--transcode-cache': 'off',
+                      '--transcode-cache-size': '10240',
+                      '--piece-length': 'auto',
+                      '--hash-early': 'False'}
 
 
 def merge_conf(conf1, conf2):
@@ -231,66 +654,634 @@ def merge_conf(conf1, conf2):
                 for key in set(conf2) | set(conf1))
 
 
-def make_torrent(target, announce_url, source, torrent_dir):
-    base = os.path.basename(target)
+def default_cache_dir():
+    """The directory in which OATS keeps its caches, per platform."""
+    if platform.system() == 'Windows':
+        base = os.getenv('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), 'AppData', 'Local')
+    else:
+        base = os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'oats')
+
+
+def process_limits(config):
+    """Compose the resource controls of subprocesses for the config."""
+    return ProcessLimits(nice=config['--nice'],
+                         ioclass=config['--ionice'],
+                         iolevel=config['ionice-level'],
+                         cpus=config['--cpus'],
+                         memory=config['--memory-limit'] or None)
+
+
+def concurrency_controller(config):
+    """
+    Compose the controller of the number of tasks in flight, if adaptive. It
+    starts at one task per core and may go as far as two per core.
+    """
+    if not config['adaptive']:
+        return None
+    cores = config['--processes'] or os.cpu_count() or 1
+    return ConcurrencyController(cores, 2 * cores)
+
+
+def device_scheduler(config):
+    """Return the limiter of the I/O heavy work on each device, if enabled."""
+    if config['--io-per-device'] is None:
+        return None
+    if config['--io-per-device'] == 'auto':
+        return DeviceScheduler()
+    return DeviceScheduler(config['--io-per-device'])
+
+
+def piece_cache(config):
+    """Return the torrent piece hash cache for the config, if enabled."""
+    if config['--hash-cache'] is None:
+        return None
+    return maketorrent.PieceCache(config['--hash-cache'])
+
+
+def transcode_cache(config):
+    """Return the transcode cache for the config, if enabled."""
+    if config['--transcode-cache'] is None:
+        return None
+    return TranscodeCache(config['--transcode-cache'], config['--transcode-cache-size'])
+
+
+def option_strings(options):
+    """
+    Convert library options into config file form, named like "--formats"
+    with string values.
+    """
+    strings = {}
+    for key, value in options.items():
+        if value is None:
+            continue
+        if not key.startswith('--'):
+            key = '--' + key.replace('_', '-')
+        if isinstance(value, (list, tuple)):
+            value = ','.join(str(v) for v in value)
+        strings[key] = str(value)
+    return strings
+
+
+def normalize_configuration(bconf):
+    """
+    Convert the string values of a merged configuration into the values used
+    by OATS, returning the configuration.
+    """
+    bconf['adaptive'] = bconf['--processes'].lower() == 'auto'
+    if bconf['adaptive'] or bconf['--processes'] == '0':
+        bconf['--processes'] = None
+    else:
+        bconf['--processes'] = codec.sane_int(bconf['--processes'], '--processes', minval=0)
+    bconf['--nice'] = codec.sane_int(bconf['--nice'], '--nice', minval=0, maxval=19)
+    ioclass, _sep, iolevel = bconf['--ionice'].lower().partition(':')
+    if ioclass not in ['none'] + list(IONICE_CLASSES):
+        raise InvalidConfiguration('Unknown I/O scheduling class: {}'.format(ioclass))
+    bconf['--ionice'] = None if ioclass == 'none' else ioclass
+    bconf['ionice-level'] = codec.sane_int(iolevel, '--ionice', minval=0, maxval=7) if iolevel else None
+    try:
+        bconf['--cpus'] = parse_cpu_list(bconf['--cpus'])
+    except ValueError as e:
+        raise InvalidConfiguration(str(e))
+    if bconf['--cpus']:
+        if not hasattr(os, 'sched_setaffinity'):
+            raise InvalidConfiguration('Pinning to CPUs is not supported on this system')
+        unavailable = bconf['--cpus'] - os.sched_getaffinity(0)
+        if unavailable:
+            raise InvalidConfiguration('CPUs not available to OATS: {}'.format(sorted(unavailable)))
+        if bconf['--processes'] is None:
+            bconf['--processes'] = len(bconf['--cpus'])
+    bconf['--memory-limit'] = codec.sane_int(bconf['--memory-limit'], '--memory-limit', minval=0) * 2**20
+    if os.name != 'posix' and (bconf['--nice'] or bconf['--ionice'] or bconf['--memory-limit']):
+        raise InvalidConfiguration('Process priorities and limits are only supported on POSIX systems')
+    if bconf['--io-per-device'].lower() != 'auto':
+        bconf['--io-per-device'] = codec.sane_int(bconf['--io-per-device'], '--io-per-device', minval=0) or None
+    bconf['--source'] = None if bconf['--source'] == 'None' else bconf['--source']
+    if bconf['--hash-cache'].lower() in ['off', 'none', 'false']:
+        bconf['--hash-cache'] = None
+    elif bconf['--hash-cache'] == '':
+        bconf['--hash-cache'] = os.path.join(default_cache_dir(), 'pieces')
+    else:
+        bconf['--hash-cache'] = os.path.abspath(os.path.expanduser(bconf['--hash-cache']))
+    if bconf['--transcode-cache'].lower() in ['off', 'none', 'false', '']:
+        bconf['--transcode-cache'] = None
+    elif bconf['--transcode-cache'].lower() == 'default':
+        bconf['--transcode-cache'] = os.path.join(default_cache_dir(), 'transcodes')
+    else:
+        bconf['--transcode-cache'] = os.path.abspath(os.path.expanduser(bconf['--transcode-cache']))
+    bconf['--transcode-cache-size'] = codec.sane_int(bconf['--transcode-cache-size'], '--transcode-cache-size',
+                                                     minval=1) * 2**20
+    bconf['--torrent'] = True if bconf['--torrent'].lower() in ['1','t','true'] else False
+    bconf['--hash-early'] = True if bconf['--hash-early'].lower() in ['1','t','true'] else False
+    if bconf['--piece-length'].lower() == 'auto':
+        bconf['--piece-length'] = None
+    else:
+        piece_length = codec.sane_int(bconf['--piece-length'], '--piece-length', minval=16)
+        if piece_length & (piece_length - 1):
+            raise InvalidConfiguration('The piece length must be a power of two: {}'.format(piece_length))
+        bconf['--piece-length'] = piece_length * 2**10
+    bconf['--list-file'] = True if bconf['--list-file'] in [True, 'true', 'True'] else False
+    bconf['--force-encode'] = True if bconf['--force-encode'].lower() in ['1','t','true'] else False
+    bconf['--split-cue'] = True if bconf['--split-cue'].lower() in ['1','t','true'] else False
+    bconf['--replaygain'] = True if bconf['--replaygain'].lower() in ['1','t','true'] else False
+    if bconf['--replaygain'] and loudness is None:
+        raise InvalidConfiguration('ReplayGain enabled but NumPy is not installed!')
+    if bconf['--shard']:
+        index, _sep, count = bconf['--shard'].partition('/')
+        count = codec.sane_int(count, '--shard', minval=1)
+        bconf['--shard'] = (codec.sane_int(index, '--shard', minval=1, maxval=count), count)
+    else:
+        bconf['--shard'] = None
+    #Torrents and album gain need every file of a target, so whole targets are sharded
+    bconf['shard-targets'] = bconf['--torrent'] or bconf['--replaygain']
+    bconf['--preflight'] = bconf['--preflight'].lower()
+    if bconf['--preflight'] not in ['off', 'report', 'exclude', 'abort']:
+        raise InvalidConfiguration('Unknown preflight mode: {}'.format(bconf['--preflight']))
+    bconf['--verify-md5'] = True if bconf['--verify-md5'].lower() in ['1','t','true'] else False
+    bconf['--task-timeout'] = codec.sane_int(bconf['--task-timeout'], '--task-timeout', minval=0) or None
+    if bconf['--metrics'].lower() in ['', 'off', 'none', 'false']:
+        bconf['--metrics'] = None
+    elif not bconf['--metrics'].isdigit():
+        bconf['--metrics'] = os.path.abspath(os.path.expanduser(bconf['--metrics']))
+    bconf['--chunk-duration'] = codec.sane_int(bconf['--chunk-duration'], '--chunk-duration', minval=0)
+    #Normalization of formats into list of namedtuple('Format', ['type', 'subtype'])
+    raw_formats = bconf['--formats']
+    raw_profiles = bconf['--profile']
+    bconf['--formats'] = []
+    for raw_format in raw_formats.upper().split(','):
+        if raw_format == '':  # Ignore empty format fields
+            continue
+        bconf['--formats'].append(Format.fromstring(raw_format))
+    #The default profile, then those of particular formats like "MP3 CBR 128=fast"
+    bconf['--profile'], overrides = codec.DEFAULT_PROFILE, {}
+    for entry in raw_profiles.split(','):
+        if entry.strip() == '':
+            continue
+        name, sep, profile = entry.rpartition('=')
+        profile = profile.strip().lower()
+        if profile not in codec.PROFILES:
+            raise InvalidConfiguration('Unknown profile "{}", expected one of: {}'.format(
+                profile, ', '.join(codec.PROFILES)))
+        if sep:
+            overrides[' '.join(name.upper().split())] = profile
+        else:
+            bconf['--profile'] = profile
+    unknown = set(overrides) - set(str(fmt) for fmt in bconf['--formats'])
+    if unknown:
+        raise InvalidConfiguration('Profiles given for formats not requested: {}'.format(', '.join(sorted(unknown))))
+    for fmt in bconf['--formats']:
+        fmt.profile = overrides.get(str(fmt), bconf['--profile'])
+    return bconf
+
+
+def check_formats(config):
+    """
+    Determine if any requested formats have no codec tools, or are not valid
+    for the tool which will encode them. Valid formats are so compiled once,
+    before any work is begun (see codec.Codec.compile).
+    """
+    for fmt in config['--formats']:
+        if fmt.type not in format_codec_map:
+            raise InvalidConfiguration('The format of type "{}" is not known to OATS'.format(fmt.type))
+        if not format_codec_map[fmt.type]:  #The list of available codec tools is empty
+            raise InvalidConfiguration('No valid tools for "{}" on the system'.format(fmt.type))
+        try:
+            format_codec_map[fmt.type][0].compile(fmt.subtype, fmt.profile)
+        except ValueError as e:
+            raise InvalidConfiguration('Invalid format "{}": {}'.format(fmt, e))
+
+
+def make_torrent(target, announce_url, source, torrent_dir, cache=None, early=None, devices=None,
+                 piece_length=None, pool=None):
+    """
+    Make the torrent of a target in the torrent directory. This does not
+    change the working directory, so torrents may be made from threads
+    alongside the transcodes. The pieces hashed by an EarlyHasher are used
+    if given and still valid. With a DeviceScheduler, the target is only
+    read once there is a place on its device. Its pieces are hashed by the
+    maketorrent.HashPool `pool`, if given, with the given piece length or
+    one chosen by its size.
+    """
+    base = os.path.basename(os.path.abspath(target))
     torrent_output = os.path.abspath(os.path.join(torrent_dir, base + '.torrent'))
     if os.path.isfile(torrent_output):
         raise FileExistsError('File already exists, unable to create torrent: {}'.format(torrent_output))
-    cwd = os.getcwd()
-    rebase = os.chdir(os.path.split(target)[0])
-    target = os.path.split(target)[1]
-    maketorrent.mktorrent(target, torrent_output, tracker=announce_url, source=source)
-    os.chdir(cwd)
+    hasher = None
+    if early is not None:
+        early.advance()
+        hasher = early.hasher
+    with devices.hold(target) if devices is not None else nullcontext():
+        torrent = maketorrent.buildTorrent(target, tracker=announce_url, piecesize=piece_length, source=source,
+                                           cache=cache, hasher=hasher, pool=pool)
+    #Opened exclusively, in case another thread has made a torrent of the same name meanwhile
+    with open(torrent_output, 'xb') as outfile:
+        outfile.write(maketorrent.bencode.Bencode(torrent))
+    return torrent_output
+
+
+def make_torrents(targets, announce_url, source, torrent_dir, processes=None, cache=None, devices=None,
+                  piece_length=None):
+    """
+    Make the torrents of several targets as one batch, reporting each as it
+    is made and the hashing of the batch at the end. Up to `processes`
+    targets are read at once, and their pieces hashed by a shared pool of as
+    many threads. Returns the number of torrents that could not be made.
+    """
+    failures = 0
+    hashers = maketorrent.HashPool(processes)
+    with ThreadPoolExecutor(processes) as pool:
+        futures = dict((pool.submit(make_torrent, target, announce_url, source, torrent_dir, cache,
+                                    devices=devices, piece_length=piece_length, pool=hashers), target)
+                       for target in targets)
+        for future in as_completed(futures):
+            try:
+                print('Made torrent {}'.format(future.result()))
+            except (OSError, ValueError) as e:
+                failures += 1
+                print('Unable to make torrent for {}: {}'.format(futures[future], e))
+    hashers.shutdown()
+    if hashers.report() is not None:
+        print(hashers.report())
+    return failures
 
 
-def traverse_target(target, config):
+class TranscodeTemplate(object):
+    """
+    The commands which decode a source to wav, encode it to a format and copy
+    its metadata, shared by every transcode of a destination. The commands of
+    a task are composed from its paths only as it is run. The destination
+    directory is made by the decode, so that no directory is made before
+    there is work for it. If an AlbumLoudness is given, the decoded wav is
+    also measured. The encode command is the format's compiled
+    codec.EncodeTemplate, at the effort profile of the format.
+
+    With a TranscodeCache, an output cached under the same `identity` of
+    the tools and command is used instead of encoding the source again, and
+    new outputs are added to the cache before they are tagged.
+    """
+    __slots__ = ('decoder', 'encoder', 'fmt', 'album', 'encode', 'cache', 'identity')
+
+    def __init__(self, decoder, encoder, fmt, album=None, cache=None):
+        self.decoder = decoder
+        self.encoder = encoder
+        self.fmt = fmt
+        self.album = album
+        self.encode = encoder.compile(fmt.subtype, fmt.profile)
+        self.cache = cache
+        self.identity = None
+        if cache is not None:
+            self.identity = [encoder.__name__, encoder.version(), decoder.__name__, decoder.version(),
+                             [str(arg) for arg in self.encode.argv], sorted(self.encode.requires.items())]
+
+    def decode(self, source_file, wav_dest, start=None, end=None, threads=1):
+        os.makedirs(os.path.dirname(wav_dest), exist_ok=True)
+        return self.decoder.decode(source_file, wav_dest, start=start, end=end, threads=threads,
+                                   **self.encode.requires)
+
+    def commands(self, source_file, dest, start=None, end=None, tags=None):
+        wav_dest = os.path.splitext(dest)[0] + '.wav'
+        cached = None
+        if self.cache is not None:
+            cached = CachedTranscode(self.cache, self.identity, source_file, dest, start, end)
+            yield cached.fetch
+        #A cached output is only decoded if its loudness is to be measured
+        if cached is None or not cached.hit or self.album is not None:
+            yield partial(self.decode, source_file, wav_dest, start, end)
+            if cached is None or not cached.hit:
+                yield partial(self.encode.command, wav_dest, dest)
+            if self.album is not None:
+                yield partial(self.album.measure, (source_file, start), None, wav_dest)
+            yield partial(remove_files, wav_dest)
+            if cached is not None and not cached.hit:
+                yield cached.store
+        metacopy_command = ['metacopy', source_file, dest]
+        if tags is not None:
+            metacopy_command += ['{}={}'.format(k, v) for k, v in sorted(tags.items())]
+        yield metacopy_command
+
+
+def transcode_task(template, source_file, dest_dir, name, start=None, end=None, tags=None):
+    """
+    Compose the task which transcodes a source file (or the [start, end)
+    time range of it) to the destination directory by a TranscodeTemplate.
+    """
+    dest = os.path.abspath(os.path.join(dest_dir, name + template.encoder.extension))
+    if template.album is not None:
+        template.album.register((source_file, start), dest)
+    args = () if start is None and end is None and tags is None else (start, end, tags)
+    return Task(template=template,
+                args=args,
+                partials=(os.path.splitext(dest)[0] + '.wav', dest),
+                output=dest,
+                kind='transcode',
+                source=source_file)
+
+
+def audio_duration(path):
+    """The duration of an audio file in seconds, read from its headers, or 0.0"""
+    try:
+        audio = mutagen.File(path)
+    except (mutagen.MutagenError, OSError):
+        return 0.0
+    if audio is None or audio.info is None:
+        return 0.0
+    return getattr(audio.info, 'length', 0.0) or 0.0
+
+
+def write_album_gain(album, threads=1):
+    """Write the ReplayGain tags of every output of an album, in-process."""
+    for output, gains in album.gains():
+        if not os.path.isfile(output):
+            continue
+        try:
+            metacopy.write_replaygain(output, gains,
+                                      replaygain_reference=loudness.REPLAYGAIN_REFERENCE,
+                                      r128_reference=loudness.R128_REFERENCE)
+        except mutagen.MutagenError as e:
+            print('Unable to write ReplayGain tags to {}: {}'.format(output, e))
+    return None
+
+
+def md5_command(path, md5file, threads=1):
+    """
+    Return the command which writes the MD5 of the decoded audio of a joined
+    FLAC file, at the bit depth of its STREAMINFO.
+    """
+    return FFMPEG.md5(path, md5file, flacjoin.bit_depth(path), threads=threads)
+
+
+def chunkable(template, stream, chunk_duration):
+    """
+    Whether a source of the probed `stream` is encoded in segments of
+    `chunk_duration` seconds by a TranscodeTemplate: when it is longer than
+    two segments, the segments of its format join losslessly, and it is
+    neither resampled nor changed in bit depth. A resampler (or dither)
+    starting afresh in every segment would leave a discontinuity at each
+    join.
+    """
+    if not chunk_duration or not template.encoder.concatenable or FFMPEG is None or not stream:
+        return False
+    duration = stream.get('duration')
+    if duration is None or duration <= 2 * chunk_duration:
+        return False
+    return all(stream.get(key) == value for key, value in template.encode.requires.items())
+
+
+def chunked_tasks(template, source_file, dest_dir, name, duration, chunk_duration, groups=(), result=None):
+    """
+    Yield the tasks which encode a long source as segments of
+    `chunk_duration` seconds in parallel, followed by the task which joins
+    the segments losslessly and copies the metadata once they are all done.
+    If the TranscodeTemplate has an AlbumLoudness, each segment is measured
+    as a part of the track. The joining task is added to the given groups, and all of the
+    tasks to the DestinationResult if given.
+
+    The segments are joined by flacjoin, renumbering their frames, and the
+    MD5 of the joined audio is set in its STREAMINFO once it is decoded.
+    """
+    encoder, album = template.encoder, template.album
+    dest = os.path.abspath(os.path.join(dest_dir, name + encoder.extension))
+    md5file = dest + '.md5'
+    count = int(math.ceil(duration / chunk_duration))
+    parts = [os.path.abspath(os.path.join(dest_dir, '{}.part{:03d}{}'.format(name, i, encoder.extension)))
+             for i in range(count)]
+    join = Task(partial(flacjoin.join, parts, dest),
+                partial(md5_command, dest, md5file),
+                partial(flacjoin.set_md5, dest, md5file),
+                partial(remove_files, *parts),
+                ['metacopy', source_file, dest],
+                partials=(dest, md5file),
+                output=dest,
+                kind='join',
+                source=source_file)
+    group = TaskGroup(join)
+    for other in groups:
+        other.add(join)
+    if result is not None:
+        result.add(join)
+    if album is not None:
+        album.register((source_file, None), dest)
+    for i, part in enumerate(parts):
+        start = i * chunk_duration
+        end = None if i == count - 1 else (i + 1) * chunk_duration
+        wav_dest = os.path.splitext(part)[0] + '.wav'
+        commands = [partial(template.decode, source_file, wav_dest, start, end),
+                    partial(template.encode.command, wav_dest, part)]
+        if album is not None:
+            commands.append(partial(album.measure, (source_file, None), start, wav_dest))
+        commands.append(partial(remove_files, wav_dest))
+        task = Task(*commands, partials=(wav_dest, part), kind='segment', source=source_file)
+        task.work = (duration if end is None else end) - start
+        if result is not None:
+            result.add(task)
+        yield group.add(task)
+    followup = group.close()
+    if followup is not None:
+        yield followup
+
+
+def shard_of(key, count):
+    """The shard, from 1 to `count`, of a key by a hash stable across machines"""
+    digest = hashlib.sha1(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count + 1
+
+
+def shard_key(target, relpath=None):
+    """
+    The sharding key of a target, or of a file within it. Only the name of
+    the target is used, so that machines may mount targets at other paths.
+    """
+    key = os.path.basename(os.path.abspath(target))
+    if relpath is not None:
+        key += '/' + os.path.normpath(relpath).replace(os.sep, '/')
+    return key
+
+
+def in_shard(config, target, relpath=None):
+    """
+    Whether a target (if no `relpath` is given), or a file within it, is in
+    the shard of this machine. Whole targets are sharded when their
+    destinations must be complete, otherwise source files are sharded.
+    """
+    if config['--shard'] is None:
+        return True
+    index, count = config['--shard']
+    if config['shard-targets']:
+        if relpath is not None:  # The target was already checked
+            return True
+        return shard_of(shard_key(target), count) == index
+    if relpath is None:
+        return True
+    return shard_of(shard_key(target, relpath), count) == index
+
+
+def traverse_target(target, config, results=None, cache=None):
     """
     The job of traverse_target is to recursively walk through all of the
     files in the target directory and yield commands for each of them.
     Each file will be the subject of either a copy or transcode command.
+    Album images described by a CUE sheet are split into one transcode
+    command per track. If ReplayGain is enabled, the loudness of the album
+    is measured from the decoded audio and its tags are written once every
+    transcode of the target is done. Once all of a destination's tasks are
+    done, a destination task marks its completion. The tasks of each
+    destination carry its DestinationResult, from `results` if given.
+    Transcodes use and fill the TranscodeCache `cache`, if given.
+
+    Tasks are yielded as the target is walked, and destination directories
+    are only made by the tasks which write to them, so that the tasks of a
+    target may be run while the rest of it is still being walked.
     """
     transcode_dirs = format_destinations(target, config)
-
+    if results is None:
+        results = dict((fmt, DestinationResult(target, fmt, transcode_dirs[fmt]))
+                       for fmt in config['--formats'])
+    destination_groups = dict((fmt, TaskGroup(destination_task(results[fmt])))
+                              for fmt in config['--formats'])
+    if config['--replaygain']:
+        album = loudness.AlbumLoudness()
+        album_group = TaskGroup(Task(partial(write_album_gain, album), kind='replaygain'))
+        for group in destination_groups.values():
+            group.add(album_group.followup)
+    else:
+        album, album_group = None, None
+
+    def tracked(task, fmt):
+        """Hold back the album's gain tags and the destination's completion"""
+        if album_group is not None:
+            album_group.add(task)
+        results[fmt].add(task)
+        return destination_groups[fmt].add(task)
+
+    templates = {}
+
+    def template(decoder, encoder, fmt):
+        """The TranscodeTemplate shared by the transcodes of a destination"""
+        key = (decoder, encoder, fmt)
+        if key not in templates:
+            templates[key] = TranscodeTemplate(decoder, encoder, fmt, album, cache)
+        return templates[key]
+
+    measure = config['adaptive'] or config.get('plan', False) or config['--metrics'] is not None
+    #Only images of audio that is transcoded below are split by their CUE sheets
+    decodable = set(ext for ext in AUDIO_EXTENSIONS if ext_codec_map.get(ext))
     for dirpath, _dirs, filenames in os.walk(target):
+        reldir = os.path.relpath(dirpath, target)
+        if config['--split-cue']:
+            images, used_cues = cue.find_images(dirpath, filenames, decodable)
+        else:
+            images, used_cues = {}, set()
+
         for filename in filenames:
             name, ext = os.path.splitext(filename)
             source_file = os.path.join(target, dirpath, filename)
-            reldir = os.path.relpath(dirpath, target)
+            stream = None
+            probed = False
+            #Seconds of audio in the source, measured for adaptive concurrency
+            seconds = None
+            #A passthrough output, and whether any format decodes the source
+            passthrough_dest, decoded = None, False
+            if filename in used_cues:  # The tracks it describes are tagged instead
+                continue
+            if source_file in config.get('excluded', ()):  # Failed preflight checks
+                continue
+            if not in_shard(config, target, os.path.join(reldir, filename)):
+                continue
 
             for fmt in config['--formats']:
                 dest_dir = os.path.join(transcode_dirs[fmt], reldir)
-                if not os.path.exists(dest_dir):
-                    os.makedirs(dest_dir)
                 if ext not in AUDIO_EXTENSIONS:
                     dest = os.path.abspath(os.path.join(dest_dir, filename))
-                    command = [COPY, source_file, dest]
-                    yield Task(command)
+                    yield tracked(Task(partial(copy_file, source_file, dest), partials=(dest,), output=dest,
+                                       kind='copy', source=source_file), fmt)
+                elif filename in images:
+                    sheet, cue_file = images[filename]
+                    decoder = ext_codec_map[ext][0]
+                    if not decoder.seekable:  # FFmpeg can decode a time range of any source
+                        decoder = FFMPEG
+                    encoder = format_codec_map[fmt.type][0]
+                    if measure and seconds is None:
+                        seconds = audio_duration(source_file)
+                    for track in cue_file.tracks:
+                        task = transcode_task(template(decoder, encoder, fmt), source_file, dest_dir,
+                                              track.name(),
+                                              start=track.start, end=track.end,
+                                              tags=sheet.tags(track))
+                        if measure:
+                            task.work = max(0.0, (seconds if track.end is None else track.end) - track.start)
+                        yield tracked(task, fmt)
                 else:
                     decoder = ext_codec_map[ext][0]
                     encoder = format_codec_map[fmt.type][0]
-                    wav_name = name + '.wav'
-                    wav_dest = os.path.abspath(os.path.join(dest_dir, wav_name))
                     dest_name = name + encoder.extension
                     dest = os.path.abspath(os.path.join(dest_dir, dest_name))
-                    decode_command = decoder.decode(source_file,
-                                                    wav_dest,
-                                                    **encoder.encode_requires(fmt.subtype))
-                    encode_command = encoder.encode(wav_dest,
-                                                    dest,
-                                                    fmt.subtype)
-                    rm_command = [RM, wav_dest]
-                    metacopy_command = ['metacopy', source_file, dest]
-                    yield Task(decode_command,
-                               encode_command,
-                               rm_command,
-                               metacopy_command
-                               )
-
-def iter_targets(config):
-    """Iterating over targets"""
-    if config['--list-file']:
-        for listfile in config['<target>']:
-            print('Processing listfile: {}'.format(listfile))
+                    #Sources which already satisfy the format are copied or remuxed
+                    if encoder.passthrough_codec is not None and not config['--force-encode']:
+                        if not probed and PROBE is not None:
+                            stream = PROBE.probe(source_file)
+                            probed = True
+                        if encoder.passthrough(stream, fmt.subtype):
+                            if album is not None:
+                                album.register((source_file, None), dest)
+                                passthrough_dest = dest
+                            if ext == encoder.extension:
+                                yield tracked(Task(partial(copy_file, source_file, dest),
+                                                   partials=(dest,), output=dest,
+                                                   kind='copy', source=source_file), fmt)
+                                continue
+                            elif FFMPEG is not None:
+                                yield tracked(Task(partial(remux, source_file, dest),
+                                                   ['metacopy', source_file, dest],
+                                                   partials=(dest,), output=dest,
+                                                   kind='remux', source=source_file), fmt)
+                                continue
+                    #Long sources are encoded in segments where they may be joined losslessly
+                    chunk_duration = config['--chunk-duration']
+                    if chunk_duration and encoder.concatenable and FFMPEG is not None:
+                        if not probed and PROBE is not None:
+                            stream = PROBE.probe(source_file)
+                            probed = True
+                        if chunkable(template(decoder, encoder, fmt), stream, chunk_duration):
+                            if not decoder.seekable:
+                                decoder = FFMPEG
+                            decoded = True
+                            for task in chunked_tasks(template(decoder, encoder, fmt), source_file,
+                                                      dest_dir, name, stream['duration'], chunk_duration,
+                                                      groups=[g for g in [album_group, destination_groups[fmt]]
+                                                              if g is not None],
+                                                      result=results[fmt]):
+                                yield task
+                            continue
+                    task = transcode_task(template(decoder, encoder, fmt), source_file, dest_dir, name)
+                    if measure:
+                        if seconds is None:
+                            seconds = audio_duration(source_file)
+                        task.work = seconds
+                    decoded = True
+                    yield tracked(task, fmt)
+
+            #A source only copied or remuxed is decoded for its loudness alone
+            if passthrough_dest is not None and not decoded:
+                wav_dest = os.path.splitext(passthrough_dest)[0] + '.wav'
+                yield album_group.add(Task(partial(decode_wav, ext_codec_map[ext][0], source_file, wav_dest),
+                                           partial(album.measure, (source_file, None), None, wav_dest),
+                                           partial(remove_files, wav_dest),
+                                           partials=(wav_dest,), kind='measure', source=source_file))
+
+    groups = list(destination_groups.values())
+    if album_group is not None:
+        groups.insert(0, album_group)
+    for group in groups:
+        followup = group.close()
+        if followup is not None:
+            yield followup
+
+def iter_target_paths(targets, list_file=False, verbose=True):
+    """Iterating over target paths, reading them from list files if need be"""
+    if list_file:
+        for listfile in targets:
+            if verbose:
+                print('Processing listfile: {}'.format(listfile))
             with open(listfile, 'r') as lf:
                 for target_line in lf:
                     if target_line.startswith('#'):  # Allows comment lines starting with "#"
@@ -298,18 +1289,459 @@ def iter_targets(config):
                     target = target_line.rstrip()
                     if target == '':
                         continue
-                    print('Processing {} for transcoding'.format(target))
-                    for task in traverse_target(os.path.abspath(target), config):
-                        yield task
+                    yield target
+    else:
+        for target in targets:
+            yield target
+
+
+def iter_sources(targets):
+    """Iterating over the audio source files of the target paths"""
+    for target in targets:
+        for dirpath, _dirs, filenames in os.walk(os.path.abspath(target)):
+            for filename in filenames:
+                if os.path.splitext(filename)[1] in AUDIO_EXTENSIONS:
+                    yield os.path.join(dirpath, filename)
+
+
+def imap_by_device(pool, function, paths, devices, processes):
+    """
+    Like Pool.imap_unordered, but only starting work on a path once there
+    is a place on its device (see engine.DeviceScheduler), keeping up to
+    `processes` paths in work. Paths waiting for their device are set aside,
+    and the paths after them are worked on meanwhile.
+    """
+    finished = queue.Queue()
+    deferred = []  # (path, devices) waiting for a place on their devices
+    in_flight = 0
+    exhausted = False
+    paths = iter(paths)
+
+    def done(held, result):
+        devices.release(held)
+        finished.put(result)
+
+    while True:
+        while in_flight < processes:
+            #The first path set aside whose devices now have a place, taking it
+            item = next((item for item in deferred if devices.acquire(item[1], blocking=False)), None)
+            if item is not None:
+                deferred.remove(item)
+            elif exhausted or len(deferred) >= IO_LOOKAHEAD:
+                break
+            else:
+                try:
+                    path = next(paths)
+                except StopIteration:
+                    exhausted = True
+                    continue
+                try:
+                    item = (path, devices.devices(path))
+                except OSError:  # Left to the function to report
+                    item = (path, frozenset())
+                if not devices.acquire(item[1], blocking=False):
+                    deferred.append(item)
+                    continue
+            in_flight += 1
+            pool.apply_async(function, (item[0],),
+                             callback=partial(done, item[1]), error_callback=partial(done, item[1]))
+        if in_flight == 0:
+            if not deferred:
+                return
+            #The devices are held by work elsewhere, so wait for them
+            path, held = deferred.pop(0)
+            devices.acquire(held)
+            in_flight += 1
+            pool.apply_async(function, (path,), callback=partial(done, held), error_callback=partial(done, held))
+            continue
+        result = finished.get()
+        in_flight -= 1
+        if isinstance(result, BaseException):
+            raise result
+        yield result
+
+
+def run_preflight(config, sources, pool=None, devices=None):
+    """
+    Check the audio source files in parallel before they are transcoded, by
+    the multiprocessing Pool if given, or else a new one. Prints a report of
+    the problems found and returns the set of bad files. The files of each
+    device are checked as limited by --io-per-device, sharing the places on
+    each device with other work by the DeviceScheduler if given.
+    """
+    if pool is None:
+        with Pool(config['--processes']) as pool:
+            return run_preflight(config, sources, pool, devices)
+    check = partial(preflight.check_file, verify_md5=config['--verify-md5'])
+    if devices is None:
+        devices = device_scheduler(config)
+    bad = set()
+    count = 0
+    if devices is None:
+        checked = pool.imap_unordered(check, sources, chunksize=4)
     else:
-        for target in config['<target>']:
+        checked = imap_by_device(pool, check, sources, devices, config['--processes'] or os.cpu_count() or 1)
+    for path, problems in checked:
+        count += 1
+        if problems:
+            bad.add(path)
+            print('Preflight: {}'.format(path))
+            for problem in problems:
+                print('    {}'.format(problem))
+    print('Preflight checked {} source files, {} with problems'.format(count, len(bad)))
+    return bad
+
+
+def plan(config, targets):
+    """
+    Compose the plan of transcoding the targets: every task of every shard,
+    with the shard it belongs to and its estimated cost, as the seconds of
+    audio it transcodes and the bytes it copies. Tasks with no shard are run
+    by every shard. The totals of each shard show how well balanced they are.
+    """
+    count = config['--shard'][1] if config['--shard'] else 1
+    config = dict(config, plan=True, **{'--shard': None})
+    tasks = []
+    totals = [{'shard': shard, 'tasks': 0, 'seconds': 0.0, 'bytes': 0} for shard in range(1, count + 1)]
+    for target in targets:
+        target = os.path.abspath(target)
+        for task in traverse_target(target, config):
+            if config['shard-targets']:
+                shard = shard_of(shard_key(target), count)
+            elif task.source is not None:
+                shard = shard_of(shard_key(target, os.path.relpath(task.source, target)), count)
+            else:
+                shard = None
+            size = 0
+            if task.kind in ('copy', 'remux'):
+                size = os.path.getsize(task.source)
+            tasks.append({'shard': shard,
+                          'kind': task.kind,
+                          'target': target,
+                          'source': task.source,
+                          'output': task.output or task.destination,
+                          'format': str(task.result.format) if task.result is not None else None,
+                          'seconds': round(task.work, 3),
+                          'bytes': size})
+            if shard is not None:
+                totals[shard - 1]['tasks'] += 1
+                totals[shard - 1]['seconds'] += task.work
+                totals[shard - 1]['bytes'] += size
+    for total in totals:
+        total['seconds'] = round(total['seconds'], 3)
+    return {'shards': count,
+            'sharding': 'targets' if config['shard-targets'] else 'files',
+            'tasks': tasks,
+            'totals': totals}
+
+
+class Transcoder(object):
+    """
+    The library interface of OATS. A Transcoder is built from a dictionary of
+    options, named as in the config file (like "--formats") or as keyword
+    style names (like "formats" or "output_dir"), with values as strings or
+    plain Python values. Options not given take their default values, or
+    those of `config_file` if given.
+
+    Targets may be submitted at any time from any thread once the Transcoder
+    is started, and are transcoded by a shared engine running in a
+    background thread. Each submission returns a concurrent.futures.Future
+    per format, resolved with the DestinationResult of its destination once
+    all of its transcodes (and its torrent, if enabled) are done.
+
+        with Transcoder({'formats': 'MP3 VBR 0,FLAC 16 44100', 'output_dir': 'out'}) as transcoder:
+            for future in transcoder.submit('Some Album [FLAC]'):
+                future.add_done_callback(lambda f: print(f.result()))
+
+    At most `queue_size` targets wait to be started, beyond which submit()
+    blocks, so that submitting a long list of targets holds no more than a
+    few of them in memory at once.
+
+    Leaving the `with` block waits for all submitted targets to be done, or
+    if an exception was raised, stops the running transcodes. Should the
+    engine itself fail, the futures not yet done are given its exception,
+    which is raised again by join() and on leaving the `with` block.
+    """
+    def __init__(self, options=None, config_file=None, queue_size=QUEUE_SIZE):
+        config = ConfigParser(interpolation=ExtendedInterpolation())
+        initialize_configuration(config)
+        if config_file is not None:
+            resolve_configuration(config_file, config)
+        self.config = normalize_configuration(merge_conf(option_strings(options or {}), config['OATS']))
+        check_formats(self.config)
+        if self.config['--torrent'] and self.config['--announce-url'] in ['', 'None']:
+            raise InvalidConfiguration('Torrent creation enabled but no announce url provided!')
+        for directory in [self.config['--output-dir'], self.config['--torrent-dir']]:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        self.pending = {}  # DestinationResult -> Future
+        self.lock = threading.Condition()
+        self.queue_size = queue_size
+        self.queued = 0  # Targets submitted and not yet started
+        self.thread = None
+        self.loop = None
+        self.queue = None
+        self.main = None
+        self.torrent_pool = None
+        self.closed = False
+        self.error = None  # The exception which stopped the engine
+        self.cache = transcode_cache(self.config)
+        self.devices = device_scheduler(self.config)
+        self.metrics = None
+        if self.config['--metrics'] is not None:
+            self.metrics = metrics.Metrics(self.config['--output-dir'])
+
+    def preflight(self, targets, pool=None):
+        """
+        Check the audio sources of the targets in parallel, by the
+        multiprocessing Pool if given, returning the set of bad files. The
+        checks share the places on each device with the transcoder's tasks.
+        In the "exclude" preflight mode, bad files are left out of later
+        transcodes.
+        """
+        sources = (source
+                   for target in targets if in_shard(self.config, target)
+                   for source in iter_sources([target])
+                   if in_shard(self.config, target, os.path.relpath(source, os.path.abspath(target))))
+        bad = run_preflight(self.config, sources, pool, self.devices)
+        if self.config['--preflight'] == 'exclude':
+            self.config['excluded'] = self.config.get('excluded', set()) | bad
+        return bad
+
+    def start(self):
+        """Start the engine in a background thread"""
+        if self.thread is None:
+            started = threading.Event()
+            self.thread = threading.Thread(target=self._main, args=(started,), name='oats-transcoder', daemon=True)
+            self.thread.start()
+            started.wait()
+        return self
+
+    def submit(self, target):
+        """
+        Queue a target directory for transcoding, returning a list of
+        futures of its DestinationResults in the order of the formats. The
+        list is empty if the target is left to another shard. Blocks while
+        `queue_size` targets are waiting to be started, unless called from
+        the engine's thread, as by the callback of a future.
+        """
+        if self.thread is None:
+            self.start()
+        target = os.path.abspath(target)
+        if not in_shard(self.config, target):
+            return []
+        destinations = format_destinations(target, self.config)
+        results = dict((fmt, DestinationResult(target, fmt, destinations[fmt]))
+                       for fmt in self.config['--formats'])
+        if self.config['--torrent'] and self.config['--hash-early'] and not self.config['--replaygain']:
+            for result in results.values():
+                result.early = EarlyHasher(self.config['--piece-length'])
+        for result in results.values():
+            result.metrics = self.metrics
+        futures = []
+        with self.lock:
+            if threading.current_thread() is not self.thread:
+                self.lock.wait_for(lambda: self.closed or self.queued < self.queue_size)
+            if self.error is not None:
+                raise RuntimeError('The Transcoder stopped on an error') from self.error
+            if self.closed:
+                raise RuntimeError('Targets may not be submitted to a closed Transcoder')
+            for fmt in self.config['--formats']:
+                future = Future()
+                self.pending[results[fmt]] = future
+                futures.append(future)
+            self.queued += 1
+            if self.metrics is not None:
+                self.metrics.targets_queued = self.queued
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, (target, results))
+        return futures
+
+    def close(self):
+        """Accept no further targets, letting the engine stop once those queued are done"""
+        with self.lock:
+            if not self.closed and self.loop is not None:
+                self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+            self.closed = True
+            self.lock.notify_all()
+
+    def cancel(self):
+        """Stop all running transcodes and cancel the futures of any not yet done"""
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self.main.cancel)
+
+    def join(self, timeout=None):
+        """
+        Wait for the engine to stop, after close() or cancel(), raising the
+        exception which stopped it if it failed.
+        """
+        if self.thread is not None:
+            self.thread.join(timeout)
+            if self.error is not None and not self.thread.is_alive():
+                raise self.error
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.cancel()
+        if self.thread is None:
+            return
+        try:
+            self.thread.join()
+        except BaseException:  # Interrupted while waiting, as by Ctrl-C
+            self.cancel()
+            self.thread.join()
+            raise
+        if exc_type is None:
+            self.join()
+
+    def _main(self, started):
+        try:
+            asyncio.run(self._run(started))
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            if self.error is None:  # Failed outside of the engine's run
+                self.error = e
+        finally:
+            started.set()  # Should the engine fail before it starts
+
+    async def _tasks(self):
+        """
+        Yield the tasks of each target as it is taken from the queue. The
+        target is walked and its sources probed in the default executor, a
+        task at a time, so that the event loop is free to run the engine.
+        """
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            target, results = item
+            with self.lock:
+                self.queued -= 1
+                self.lock.notify()
+                if self.metrics is not None:
+                    self.metrics.targets_queued = self.queued
             print('Processing {} for transcoding'.format(target))
-            for task in traverse_target(os.path.abspath(target), config):
+            tasks = traverse_target(target, self.config, results, self.cache)
+            while True:
+                task = await self.loop.run_in_executor(None, next, tasks, None)
+                if task is None:
+                    break
+                if task.destination is not None:  # Released as the traversal ends
+                    self._plan_early(task.result)
                 yield task
+            for result in results.values():
+                self._plan_early(result)
+
+    def _plan_early(self, result):
+        """Order the early hashing of a destination, once all its outputs are planned"""
+        if result.early is not None and result.early.order is None:
+            result.early.plan(result.destination, result.planned)
+            self._hash_early(result)
+
+    def _hash_early(self, result):
+        if not result.failed and self.torrent_pool is not None:
+            self.torrent_pool.submit(result.early.advance)
+
+    async def _run(self, started):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.main = asyncio.current_task()
+        started.set()
+        controller = concurrency_controller(self.config)
+        engine = Engine(self.config['--processes'], self.config['--task-timeout'],
+                        process_limits(self.config), controller, self.metrics, self.devices)
+        exporter = None
+        if self.metrics is not None:
+            try:
+                exporter = metrics.exporter(self.metrics, self.config['--metrics']).start()
+            except OSError as e:
+                print('Unable to report metrics to {}: {}'.format(self.config['--metrics'], e))
+        torrent_pool = ThreadPoolExecutor(self.config['--processes']) if self.config['--torrent'] else None
+        hashers = maketorrent.HashPool(self.config['--processes']) if self.config['--torrent'] else None
+        self.torrent_pool = torrent_pool
+        cache = piece_cache(self.config)
+        torrents = set()
+        error = None
+        try:
+            async for task in engine.run(self._tasks()):
+                result = task.result
+                if result is None:
+                    continue
+                result.record(task)
+                if task.destination is None:
+                    if result.early is not None and task.output is not None and not task.failed:
+                        result.early.done(task.output)
+                        self._hash_early(result)
+                    continue
+                if torrent_pool is None:
+                    self._resolve(result)
+                elif result.failed:
+                    print('Not making a torrent for {}, some of its transcodes failed'.format(result.destination))
+                    self._resolve(result)
+                else:
+                    print('Making torrent for {}'.format(result.destination))
+                    torrent = self.loop.run_in_executor(torrent_pool, make_torrent,
+                                                        result.destination,
+                                                        self.config['--announce-url'],
+                                                        self.config['--source'],
+                                                        self.config['--torrent-dir'],
+                                                        cache,
+                                                        result.early,
+                                                        self.devices,
+                                                        self.config['--piece-length'],
+                                                        hashers)
+                    torrent.add_done_callback(partial(self._torrent_done, result))
+                    torrent.add_done_callback(torrents.discard)
+                    torrents.add(torrent)
+            await asyncio.gather(*torrents, return_exceptions=True)
+            if controller is not None:
+                controller.report()
+            if hashers is not None and hashers.report() is not None:
+                print(hashers.report())
+        except Exception as e:
+            error = self.error = e
+            raise
+        finally:
+            if torrent_pool is not None:
+                torrent_pool.shutdown()
+            if hashers is not None:
+                hashers.shutdown()
+            if exporter is not None:
+                exporter.stop()
+            with self.lock:
+                self.closed = True
+                for future in self.pending.values():
+                    if error is None:
+                        future.cancel()
+                    else:
+                        future.set_exception(error)
+                self.pending.clear()
+                self.lock.notify_all()
+
+    def _torrent_done(self, result, torrent):
+        if torrent.cancelled():
+            return
+        if torrent.exception() is not None:
+            result.torrent_error = torrent.exception()
+            print('Unable to make torrent for {}: {}'.format(result.destination, result.torrent_error))
+        else:
+            result.torrent = torrent.result()
+        self._resolve(result)
 
-
-def task_caller(task):
-    task()
+    def _resolve(self, result):
+        result.duration = time.monotonic() - result.submitted
+        with self.lock:
+            future = self.pending.pop(result, None)
+        if future is not None:
+            future.set_result(result)
 
 
 def format_destinations(source, config):
@@ -352,12 +1784,12 @@ def iter_destinations(config):
             yield v
 
 
-def scan_filetypes(config):
+def scan_filetypes(targets):
     """
     Traverse targets and compose the set of all input audio filetypes.
     """
     filetypes = set()
-    for target in config['<target>']:
+    for target in targets:
         for _dirpath, _dirs, filenames in os.walk(target):
             for filename in filenames:
                 _name, ext = os.path.splitext(filename)
@@ -411,65 +1843,64 @@ def main():
     resolve_configuration(args['--config'], config)
 
     #Apply any arg options as overrides of the loaded config file
-    bconf = merge_conf(args, config['OATS'])
-
-    #Argument normalization
-    bconf['--processes'] = None if bconf['--processes'] == '0' else int(bconf['processes'])
-    bconf['--source'] = None if bconf['--source'] == 'None' else bconf['--source']
-    bconf['--torrent'] = True if bconf['--torrent'].lower() in ['1','t','true'] else False
-    bconf['--list-file'] = True if bconf['--list-file'] in [True, 'true', 'True'] else False
-    #Normalization of formats into list of namedtuple('Format', ['type', 'subtype'])
-    raw_formats = bconf['--formats']
-    bconf['--formats'] = []
-    for raw_format in raw_formats.upper().split(','):
-        if raw_format == '':  # Ignore empty format fields
-            continue
-        bconf['--formats'].append(Format.fromstring(raw_format))
-
-    #Make torrent output directory if necessary
-    if not os.path.isdir(bconf['--torrent-dir']):
-        os.makedirs(bconf['--torrent-dir'])
+    options = dict((key, value) for key, value in merge_conf(args, config['OATS']).items()
+                   if key.startswith('--'))
 
     #If mktorrent command in use, then make torrent files for the targets and quit
     if args['mktorrent']:
+        bconf = normalize_configuration(options)
         if bconf['--announce-url'] in ['', 'None']:  # Error if announce url is missing
             raise InvalidConfiguration('Torrent creation enabled but no announce url provided!')
-        for t in bconf['<target>']:
-            t = os.path.abspath(t)
-            make_torrent(t, bconf['--announce-url'], bconf['--source'], bconf['--torrent-dir'])
+        #Make torrent output directory if necessary
+        if not os.path.isdir(bconf['--torrent-dir']):
+            os.makedirs(bconf['--torrent-dir'])
+        failures = make_torrents(args['<target>'],
+                                 bconf['--announce-url'],
+                                 bconf['--source'],
+                                 bconf['--torrent-dir'],
+                                 bconf['--processes'],
+                                 piece_cache(bconf),
+                                 device_scheduler(bconf),
+                                 bconf['--piece-length'])
+        sys.exit(1 if failures else 0)
+
+    #If plan command in use, then print the plan of the transcodes and quit
+    if args['plan']:
+        bconf = normalize_configuration(options)
+        check_formats(bconf)
+        targets = list(iter_target_paths(args['<target>'], bconf['--list-file'], verbose=False))
+        with redirect_stdout(sys.stderr):  # Keep any reports out of the JSON
+            job = plan(bconf, targets)
+        json.dump(job, sys.stdout, indent=2)
+        print()
         sys.exit(0)
 
-    #Acquire a complete set of all input audio filetypes
-    input_filetypes = scan_filetypes(bconf)
-    #Check to see if there are any input audio filetypes not currently supported
-    for input_filetype in input_filetypes:
-        if input_filetype not in ext_codec_map:
-            raise NotSupportedError('OATS found an audio filetype it does not support as input: {}'.format(input_filetype))
-
-    #Determine if any requested formats have no codec tools
-    for fmt in bconf['--formats']:
-        if fmt.type not in format_codec_map:
-            raise InvalidConfiguration('The format of type "{}" is not known to OATS'.format(fmt.type))
-        if not format_codec_map[fmt.type]:  #The list of available codec tools is empty
-            raise InvalidConfiguration('No valid tools for "{}" on the system'.format(fmt.type))
-
-    #Make output directory if necessary
-    if not os.path.isdir(bconf['--output-dir']):
-        os.makedirs(bconf['--output-dir'])
-
-    #Process the source targets for transcodes
-    with ThreadPool(bconf['--processes']) as p:
-        print('Transcoding!')
-        p.map(task_caller, iter_targets(bconf))
+    transcoder = Transcoder(options)
+    checking = transcoder.config['--preflight'] != 'off'
+    skipped = False
+
+    print('Transcoding!')
+    try:
+        #The preflight pool is made before the engine's thread is started
+        with (Pool(transcoder.config['--processes']) if checking else nullcontext()) as pool, transcoder:
+            #Each target is checked as it is queued, while those before it are transcoded
+            for target in iter_target_paths(args['<target>'], transcoder.config['--list-file']):
+                unsupported = [ext for ext in sorted(scan_filetypes([target])) if not ext_codec_map.get(ext)]
+                if unsupported:
+                    print('Skipping {}: OATS found audio filetypes it does not support as input: {}'.format(
+                        target, ', '.join(unsupported)))
+                    skipped = True
+                    continue
+                if checking:
+                    bad_sources = transcoder.preflight([target], pool)
+                    if bad_sources and transcoder.config['--preflight'] == 'abort':
+                        print('Aborting: preflight found problems with source files of {}'.format(target))
+                        skipped = True
+                        break
+                transcoder.submit(target)
+    except KeyboardInterrupt:
+        print('Interrupted! Running transcodes have been stopped')
+        sys.exit(130)
     print('Transcoding done!')
-
-    #Make torrents if enabled
-    if bconf['--torrent']:
-        if bconf['--announce-url'] in ['', 'None']:  # Error if announce url is missing
-            raise InvalidConfiguration('Torrent creation enabled but no announce url provided!')
-        with Pool(bconf['--processes']) as p:
-            print('Making Torrents!')
-            p.starmap(make_torrent, [(t,
-                                      bconf['--announce-url'],
-                                      bconf['--source'],
-                                      bconf['--torrent-dir']) for t in iter_destinations(bconf)])
+    if skipped:
+        sys.exit(1)
@@ -0,0 +1,244 @@
+"""
+Content addressed transcode cache for OATS
+
+Stores the encoded output of a source keyed by the content of its audio, the
+format, and the identity and version of the tools and command which made it,
+so that byte-identical tracks, as on compilations, deluxe editions and
+re-releases, are only ever encoded once. Entries are the encoder's output
+before any tags are written, the tags of each source being written to its
+copy afterwards. The cache is bounded in size, evicting the least recently
+used entries, and may be shared by several runs or processes at once.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+from .preflight import skip_id3v2
+
+#The Linux ioctl cloning the extents of one file into another
+FICLONE = 0x40049409
+#Once over capacity, entries are evicted until this fraction of it is used
+EVICT_TO = 0.9
+HASH_BLOCK = 2**20
+
+
+def reflink(source, dest):
+    """
+    Make dest a copy-on-write clone of source where the filesystem supports
+    it, as do Btrfs and XFS, otherwise an ordinary copy.
+    """
+    if fcntl is not None:
+        try:
+            with open(source, 'rb') as src, open(dest, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+    shutil.copyfile(source, dest)
+
+
+def audio_hash(path):
+    """
+    Hash the audio of a source, leaving out its tags where the format allows,
+    so that tracks differing only in their tags have the same hash. FLAC
+    sources are identified by their STREAMINFO, which holds the MD5 of the
+    decoded audio, or where that is not set by their frames. The ID3 tags
+    of MP3 sources are left out. Other sources are hashed whole.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        end = os.fstat(f.fileno()).st_size
+        if path.lower().endswith('.flac'):
+            skip_id3v2(f)
+            if f.read(4) == b'fLaC':
+                streaminfo = None
+                while True:
+                    header = f.read(4)
+                    if len(header) < 4:
+                        raise ValueError('FLAC metadata blocks are truncated: {}'.format(path))
+                    length = int.from_bytes(header[1:4], 'big')
+                    if header[0] & 0x7F == 0:
+                        streaminfo = f.read(length)
+                    else:
+                        f.seek(length, 1)
+                    if header[0] & 0x80:
+                        break
+                if streaminfo is not None and len(streaminfo) >= 34 and streaminfo[18:34] != bytes(16):
+                    digest.update(b'STREAMINFO' + streaminfo[10:34])
+                    return digest.hexdigest()
+            else:
+                f.seek(0)
+        elif path.lower().endswith('.mp3'):
+            if end >= 128:
+                f.seek(-128, 2)
+                if f.read(3) == b'TAG':  # ID3v1
+                    end -= 128
+                f.seek(0)
+            skip_id3v2(f)
+        remaining = end - f.tell()
+        while remaining > 0:
+            block = f.read(min(HASH_BLOCK, remaining))
+            if not block:
+                break
+            digest.update(block)
+            remaining -= len(block)
+    return digest.hexdigest()
+
+
+class TranscodeCache(object):
+    """
+    A size bounded store of transcodes in a directory. Entries are found by
+    a key of the hash of the source's audio and a description of how it is
+    transcoded (see key). The audio hash of a source is itself kept in the
+    cache, by its path, size, mtime and inode, so that unchanged sources are
+    only read once. Each use of an entry updates its modification time, by
+    which the least recently used are evicted once the cache holds more than
+    `capacity` bytes. Entries are written atomically, so a cache may be
+    shared by several threads or processes.
+    """
+
+    def __init__(self, directory, capacity):
+        self.directory = directory
+        self.capacity = capacity
+        self.size = None  # Bytes held, found on first store
+        self.lock = threading.Lock()
+
+    def key(self, source, *description):
+        """Compose the key of the transcode of a source described by the given values"""
+        return hashlib.sha1(json.dumps([self.source_hash(source)] + list(description)).encode()).hexdigest()
+
+    def source_hash(self, source):
+        st = os.stat(source)
+        stat_key = hashlib.sha1(json.dumps([os.path.abspath(source), st.st_size, st.st_mtime_ns,
+                                            st.st_dev, st.st_ino]).encode()).hexdigest()
+        index = os.path.join(self.directory, 'sources', stat_key[:2], stat_key)
+        try:
+            with open(index, 'r') as entry:
+                return entry.read().strip()
+        except OSError:
+            pass
+        value = audio_hash(source)
+        self.write(index, value.encode())
+        return value
+
+    def path(self, key, extension):
+        return os.path.join(self.directory, 'outputs', key[:2], key + extension)
+
+    def fetch(self, key, extension, dest):
+        """Copy the entry of a key to dest, returning whether there was one"""
+        entry = self.path(key, extension)
+        try:
+            reflink(entry, dest)
+            os.utime(entry)
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            print('Unable to use transcode cache entry {}: {}'.format(entry, e))
+            return False
+        return True
+
+    def store(self, key, extension, output):
+        """Add a copy of an output to the cache under a key"""
+        entry = self.path(key, extension)
+        try:
+            size = os.path.getsize(output)
+            directory = os.path.dirname(entry)
+            os.makedirs(directory, exist_ok=True)
+            fd, temppath = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            os.close(fd)
+            reflink(output, temppath)
+            os.replace(temppath, entry)
+        except OSError as e:
+            print('Unable to add {} to the transcode cache: {}'.format(output, e))
+            return
+        self.grow(size)
+
+    def write(self, path, data):
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, temppath = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as entry:
+                entry.write(data)
+            os.replace(temppath, path)
+        except OSError as e:
+            print('Unable to write transcode cache entry: {}'.format(e))
+            return
+        self.grow(len(data))
+
+    def entries(self):
+        """List the (mtime, size, path) of every file in the cache"""
+        entries = []
+        for dirpath, _dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:  # Evicted meanwhile by another process
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def grow(self, size):
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for _mtime, size, _path in self.entries())
+            else:
+                self.size += size
+            if self.size > self.capacity:
+                self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is below capacity"""
+        entries = sorted(self.entries())
+        self.size = sum(size for _mtime, size, _path in entries)
+        for _mtime, size, path in entries:
+            if self.size <= self.capacity * EVICT_TO:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+
+
+class CachedTranscode(object):
+    """
+    The use of the cache by one transcode task, composed as it is run: fetch
+    is its first command, and store is run once the output is encoded if
+    there was no entry to fetch. The key is described by the `identity` of
+    the encode and the time range of the source.
+    """
+    __slots__ = ('cache', 'description', 'key', 'extension', 'source', 'dest', 'hit')
+
+    def __init__(self, cache, identity, source, dest, start=None, end=None):
+        self.cache = cache
+        self.source = source
+        self.dest = dest
+        self.extension = os.path.splitext(dest)[1]
+        self.description = (identity, start, end)
+        self.key = None
+        self.hit = False
+
+    def fetch(self, threads=1):
+        try:
+            self.key = self.cache.key(self.source, *self.description)
+        except (OSError, ValueError) as e:
+            print('Unable to hash {} for the transcode cache: {}'.format(self.source, e))
+            return None
+        os.makedirs(os.path.dirname(self.dest), exist_ok=True)
+        self.hit = self.cache.fetch(self.key, self.extension, self.dest)
+        return None
+
+    def store(self, threads=1):
+        if self.key is not None:
+            self.cache.store(self.key, self.extension, self.dest)
+        return None